@@ -28,7 +28,7 @@ class UserAdmin(DjangoUserAdmin):
     # Define admin model for custom User model with no email field
 
     fieldsets = (
-        (None, {"fields": ("email", "first_name", "last_name", "password", "primary_manager", "back_url")}),
+        (None, {"fields": ("email", "first_name", "last_name", "password", "primary_manager")}),
         (_("Preferences"), {"fields": ("default_currency", "substitute")}),
         (_("Permissions"), {"fields": ("is_active", "is_staff", "is_superuser",
                                        "groups", "user_permissions")}),
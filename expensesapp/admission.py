@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db.models import F
+from django.shortcuts import render
+
+from expensesapp.models import AdmissionCounter
+
+try:
+    import fcntl
+except ImportError:  # Windows, where uploads are only limited within each process
+    fcntl = None
+
+# Seconds that clients turned away are told to wait before trying again
+RETRY_AFTER = 15
+
+
+# Limits how many requests of one kind run at once, both within a process (with a semaphore) and across every worker
+# process on the machine (with a set of lock files, one per slot). Requests wait for a slot for up to the queue
+# timeout, so short bursts are smoothed out but a long queue doesn't tie up every worker.
+class AdmissionGate:
+    def __init__(self, name, process_limit, site_limit, lock_dir):
+        self.name = name
+        self.semaphore = threading.BoundedSemaphore(process_limit)
+        self.site_limit = site_limit
+        self.lock_dir = lock_dir
+        self.local = threading.local()
+
+    # Returns a slot to pass to release(), or None if none became free before the timeout
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        if not self.semaphore.acquire(timeout=timeout):
+            return None
+        slot_file = self.acquire_site_slot(deadline)
+        if slot_file is None:
+            self.semaphore.release()
+            return None
+        return slot_file
+
+    # Holds a slot for the rest of the with block, giving True, or gives False if none became free before the timeout.
+    # A thread that is already holding a slot keeps using it, e.g. when an upload request processes its image itself.
+    @contextmanager
+    def hold(self, timeout):
+        if getattr(self.local, "holding", False):
+            yield True
+            return
+        slot = self.acquire(timeout)
+        if slot is None:
+            yield False
+            return
+        self.local.holding = True
+        try:
+            yield True
+        finally:
+            self.local.holding = False
+            self.release(slot)
+
+    def acquire_site_slot(self, deadline):
+        if fcntl is None:
+            return True
+        os.makedirs(self.lock_dir, exist_ok=True)
+        while True:
+            for slot_num in range(self.site_limit):
+                slot_file = open(os.path.join(self.lock_dir, "{0}.{1}.lock".format(self.name, slot_num)), "a+b")
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot_file
+                except BlockingIOError:
+                    slot_file.close()
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.05)
+
+    def release(self, slot_file):
+        if fcntl is not None:
+            # Closing the file releases its lock
+            slot_file.close()
+        self.semaphore.release()
+
+
+upload_gate = None
+upload_gate_lock = threading.Lock()
+
+
+def get_upload_gate():
+    global upload_gate
+    with upload_gate_lock:
+        if upload_gate is None:
+            upload_gate = AdmissionGate("receipt_upload", settings.RECEIPT_UPLOAD_CONCURRENCY,
+                                        settings.RECEIPT_UPLOAD_SITE_CONCURRENCY, settings.RECEIPT_UPLOAD_LOCK_DIR)
+        return upload_gate
+
+
+# Counts are kept in one database row per gate and changed with single UPDATEs, so that increments made by different
+# processes at the same moment are never lost
+def record_admission(gate_name, admitted, wait_ms=0):
+    if admitted:
+        changes = {"admitted": F("admitted") + 1, "wait_ms": F("wait_ms") + wait_ms}
+    else:
+        changes = {"rejected": F("rejected") + 1}
+    if not AdmissionCounter.objects.filter(name=gate_name).update(**changes):
+        AdmissionCounter.objects.get_or_create(name=gate_name)
+        AdmissionCounter.objects.filter(name=gate_name).update(**changes)
+
+
+def get_admission_metrics(gate_name="receipt_upload"):
+    counter = AdmissionCounter.objects.filter(name=gate_name).first() or AdmissionCounter(name=gate_name)
+    metrics = {"admitted": counter.admitted, "rejected": counter.rejected, "wait_ms": counter.wait_ms}
+    metrics["average_wait_ms"] = metrics["wait_ms"] / metrics["admitted"] if metrics["admitted"] else 0
+    return metrics
+
+
+# Makes POST requests to a view wait for a slot in the upload gate before the body is read, and turns them away with
+# a 503 if none is free within RECEIPT_UPLOAD_QUEUE_TIMEOUT seconds. Other requests are let straight through.
+def limit_upload_concurrency(view):
+    @wraps(view)
+    def wrapped_view(request, *args, **kwargs):
+        if request.method != "POST":
+            return view(request, *args, **kwargs)
+        start_time = time.monotonic()
+        gate = get_upload_gate()
+        with gate.hold(settings.RECEIPT_UPLOAD_QUEUE_TIMEOUT) as admitted:
+            if not admitted:
+                record_admission(gate.name, False)
+                response = render(request, "expensesapp/busy.html", {"retry_after": RETRY_AFTER}, status=503)
+                response["Retry-After"] = str(RETRY_AFTER)
+                return response
+            record_admission(gate.name, True, round((time.monotonic() - start_time) * 1000))
+            return view(request, *args, **kwargs)
+
+    return wrapped_view
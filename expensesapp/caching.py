@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Cached values are tied to a version stamp (in their key, or stored alongside them), so a group of entries can be
+# invalidated across every worker at once by bumping the stamp in the shared cache. Stamps start from the current time
+# in milliseconds, so a stamp that has been evicted never restarts at a number that older entries were stored under.
+# Without a shared cache, stamps expire after CACHE_VERSION_TIMEOUT seconds, so each process starts a new one and
+# stops using entries that another process may have invalidated.
+
+def get_version(namespace, key):
+    version_key = "{0}_version:{1}".format(namespace, key)
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, int(time.time() * 1000), timeout=settings.CACHE_VERSION_TIMEOUT)
+        version = cache.get(version_key)
+    return version
+
+
+# Returns the versions of several keys in a namespace as {key: version}, fetching them in one lookup and starting any
+# that are missing
+def get_versions(namespace, keys):
+    version_keys = {"{0}_version:{1}".format(namespace, key): key for key in keys}
+    versions = cache.get_many(list(version_keys))
+    missing_keys = [version_key for version_key in version_keys if version_key not in versions]
+    if missing_keys:
+        stamp = int(time.time() * 1000)
+        for version_key in missing_keys:
+            cache.add(version_key, stamp, timeout=settings.CACHE_VERSION_TIMEOUT)
+        versions.update(cache.get_many(missing_keys))
+    return {version_keys[version_key]: version for version_key, version in versions.items()}
+
+
+def bump_version(namespace, key):
+    version_key = "{0}_version:{1}".format(namespace, key)
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.set(version_key, int(time.time() * 1000), timeout=settings.CACHE_VERSION_TIMEOUT)
+
+
+# Returns the current version stamp and the value cached under it by set_versioned_value(), or None for the value if
+# it's missing or was cached under an older stamp. The stamp and the value are fetched in a single lookup, and the
+# stamp is read before the caller works out a missing value, so a change made meanwhile isn't cached as current.
+def get_versioned_value(namespace, key):
+    version_key = "{0}_version:{1}".format(namespace, key)
+    value_key = "{0}:{1}".format(namespace, key)
+    values = cache.get_many([version_key, value_key])
+    version = values.get(version_key)
+    if version is None:
+        version = get_version(namespace, key)
+    versioned_value = values.get(value_key)
+    if versioned_value is None or versioned_value[0] != version:
+        return version, None
+    return version, versioned_value[1]
+
+
+def set_versioned_value(namespace, key, version, value, timeout):
+    cache.set("{0}:{1}".format(namespace, key), (version, value), timeout)
@@ -0,0 +1,5 @@
+# Adds the signed-in user's role (see User.get_role) to every page as "user_role", for the navigation bar
+def user_role(request):
+    if not request.user.is_authenticated:
+        return {}
+    return {"user_role": request.user.get_role()}
@@ -1,46 +1,163 @@
-import random
-import os
+import hashlib
+import hmac
 import math
+import secrets
+import threading
+from functools import partial
 from PIL import Image, ImageOps
-from io import BytesIO
 from django.core.files import File
+from django.db import connection, transaction
+from django.db.models import F
 
+from .receipt_images import encode_receipt_image, get_image_hash, save_derivatives
 
-# Generates a random and unique reference string for any model Class with a field called 'reference'
+
+# Generates a unique reference string for any model Class with a field called 'reference'. References are numbers
+# taken from a counter in the database and then scrambled with a keyed permutation, so they look random but can never
+# repeat. Each process reserves the counter values in blocks, so most references don't need any database queries.
 def get_unique_reference(class_obj, prefix):
+    return get_unique_references(class_obj, prefix, 1)[0]
+
+
+# Returns several new references at once, e.g. for receipts that are being created together with bulk_create()
+def get_unique_references(class_obj, prefix, count):
     length = class_obj._meta.get_field('reference').max_length - 1
     minimum_value = int("1" + (length - 1) * "0")
     maximum_value = int("9" * length)
-    first_ref_num = random.randint(minimum_value, maximum_value)
-    if not class_obj.objects.filter(reference = prefix + str(first_ref_num)).exists():
-        return prefix + str(first_ref_num)
-    ref_num = first_ref_num
-    ref_num += 1
-    while class_obj.objects.filter(reference = prefix + str(ref_num)).exists():
-        ref_num += 1
-        if ref_num > maximum_value:
-            ref_num = minimum_value
-        if ref_num == first_ref_num:
+    references = []
+    while len(references) < count:
+        counter_values, key, check_existing = reference_blocks.take(class_obj._meta.label_lower,
+                                                                    count - len(references))
+        if counter_values[-1] > maximum_value - minimum_value:
             raise Exception("AllPossibleReferencesAlreadyAssigned")
-    return prefix + str(ref_num)
+        new_references = [prefix + str(minimum_value + permute(counter_value, maximum_value - minimum_value + 1, key))
+                          for counter_value in counter_values]
+        # References created before the counter existed were picked at random, so they may collide
+        if check_existing:
+            existing_references = set(class_obj.objects.filter(reference__in=new_references)
+                                      .values_list("reference", flat=True))
+            new_references = [reference for reference in new_references if reference not in existing_references]
+        references += new_references
+    return references
+
+
+class ReferenceBlocks:
+    block_size = 20
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {}
+
+    # Returns the next reserved counter values for the named counter, along with the counter's settings. A block that
+    # is reserved inside a transaction is only kept for later references once the transaction commits, as rolling it
+    # back hands the same block to the next process that asks for one.
+    def take(self, name, count=1):
+        with self.lock:
+            counter_values = []
+            block = self.blocks.get(name)
+            while len(counter_values) < count:
+                if not block or block["next_value"] >= block["end_value"]:
+                    block = self.reserve(name, max(self.block_size, count - len(counter_values)))
+                    if connection.in_atomic_block:
+                        transaction.on_commit(partial(self.keep, name, block))
+                    else:
+                        self.blocks[name] = block
+                taken_count = min(count - len(counter_values), block["end_value"] - block["next_value"])
+                counter_values.extend(range(block["next_value"], block["next_value"] + taken_count))
+                block["next_value"] += taken_count
+            return counter_values, block["key"], block["check_existing"]
+
+    def keep(self, name, block):
+        with self.lock:
+            current_block = self.blocks.get(name)
+            if not current_block or current_block["next_value"] >= current_block["end_value"]:
+                self.blocks[name] = block
+
+    # Moves the counter on by a whole block in the database. The UPDATE comes first so that it takes the row lock
+    # (or SQLite's write lock) before the new value is read, which keeps blocks from overlapping between processes.
+    def reserve(self, name, size):
+        from .models import ReferenceCounter
+        ReferenceCounter.objects.get_or_create(name=name, defaults={"key": secrets.token_hex(32)})
+        with transaction.atomic():
+            ReferenceCounter.objects.filter(name=name).update(next_value=F("next_value") + size)
+            counter = ReferenceCounter.objects.get(name=name)
+        return {"next_value": counter.next_value - size, "end_value": counter.next_value,
+                "key": counter.key, "check_existing": counter.check_existing}
+
+
+reference_blocks = ReferenceBlocks()
+
+
+# Maps a number in the range 0 to size - 1 onto another number in the same range, using a Feistel network keyed with
+# HMAC. Results that fall outside the range are fed back in until they land inside it ('cycle walking'), which keeps
+# the mapping one-to-one.
+def permute(value, size, key):
+    half_bits = (max(size - 1, 1).bit_length() + 1) // 2
+    half_mask = (1 << half_bits) - 1
+    key = key.encode()
+    while True:
+        left = value >> half_bits
+        right = value & half_mask
+        for round_num in range(4):
+            digest = hmac.new(key, "{0}:{1}".format(round_num, right).encode(), hashlib.sha256).digest()
+            left, right = right, left ^ (int.from_bytes(digest[:8], "big") & half_mask)
+        value = (left << half_bits) | right
+        if value < size:
+            return value
+
+
+# Sets a receipt's image from an upload. Images are stored under a hash of the uploaded file, so if the same photo has
+# been uploaded before, the stored image is shared rather than decoded, encoded and stored again. The names of any
+# files it stores are added to new_file_names, so the caller can clean them up if the transaction fails.
+def handle_uploaded_file(file, receipt, new_file_names=None):
+    from .models import FileDeletion, ReceiptImageBlob
+    storage = receipt.file.storage
+    content_hash = get_content_hash(file)
+    image_blob = ReceiptImageBlob.acquire(content_hash)
+    if image_blob is None:
+        new_image = load_receipt_image(file)
+        blob, extension = encode_receipt_image(new_image)
+        new_file_name = content_hash + extension
+        # A copy of the same upload that is waiting to be deleted can't be reused or overwritten
+        if FileDeletion.objects.filter(file_name=new_file_name).exists():
+            new_file_name = "{0}_{1}{2}".format(content_hash, secrets.token_hex(4), extension)
+        new_file_name = storage.save(new_file_name, File(blob))
+        if new_file_names is not None:
+            new_file_names.append(new_file_name)
+        save_derivatives(storage, new_file_name, new_image)
+        image_blob = ReceiptImageBlob.register(content_hash, new_file_name, get_image_hash(new_image))
+    if image_blob.file_name == receipt.file.name:
+        # The receipt already had this image, and django-cleanup won't release the old reference as nothing changed
+        ReceiptImageBlob.release(image_blob.file_name)
+    receipt.file = image_blob.file_name
+    receipt.image_hash = image_blob.image_hash
+
+
+def get_content_hash(file):
+    content_hash = hashlib.sha256()
+    file.seek(0)
+    for chunk in file.chunks():
+        content_hash.update(chunk)
+    file.seek(0)
+    return content_hash.hexdigest()
 
 
-# Handles file uploads
-def handle_uploaded_file(file, receipt):
-    new_file_name = "{}_{}".format(receipt.reference, os.path.splitext(file.name)[0]+".jpeg")
+# Decodes an image file at about the size receipt images are stored at (500k pixels), the right way up. The size is
+# read from the file header first, so JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale with draft(), and other
+# formats are shrunk by whole-number factors with reduce() before the final resize. That way a large phone photo is
+# never held in memory at full resolution.
+def load_receipt_image(file, target_pixel_count=500000):
     image = Image.open(file)
     width = image.size[0]
     height = image.size[1]
     pixel_count = width * height
-    target_pixel_count = 500000
     if pixel_count > target_pixel_count:
         resize_ratio = math.sqrt(target_pixel_count / pixel_count)
         new_dimensions = (round(width * resize_ratio), round(height * resize_ratio))
-        new_image = image.resize(new_dimensions, Image.ANTIALIAS)
-        new_image = ImageOps.exif_transpose(new_image)
-    else:
-        new_image = ImageOps.exif_transpose(image)
-    blob = BytesIO()
-    new_image.save(blob, "JPEG", quality=95)
-    receipt.file.save(new_file_name, File(blob))
+        image.draft("RGB", new_dimensions)
+        image = image.resize(new_dimensions, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return image
 
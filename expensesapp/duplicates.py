@@ -0,0 +1,127 @@
+import datetime
+import threading
+
+from django.utils import timezone
+
+from expensesapp.caching import bump_version, get_version
+from expensesapp.models import Receipt
+
+# The number of bits two image hashes can differ by for the receipts to be flagged as possible duplicates. Photos of
+# the same receipt usually differ by a few bits, and different receipts by around half of the 64.
+DUPLICATE_DISTANCE = 8
+
+# How long a receipt's image can be processing before the index stops waiting for it. Images that take longer than
+# this (e.g. jobs that were left waiting after their worker died) are only indexed when the index is next rebuilt.
+PROCESSING_TIMEOUT = datetime.timedelta(hours=1)
+
+
+def get_distance(hash_a, hash_b):
+    return (hash_a ^ hash_b).bit_count()
+
+
+# A BK-tree of 64-bit image hashes. Each node's children are keyed by their distance from it, so a search only has to
+# visit the children whose distance could be within range of the hash being looked for (the triangle inequality).
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            node_value, node_items, children = node
+            distance = get_distance(value, node_value)
+            if distance == 0:
+                node_items.append(item)
+                return
+            if distance not in children:
+                children[distance] = (value, [item], {})
+                return
+            node = children[distance]
+
+    # Returns (distance, item) for every item whose hash is within max_distance of value
+    def search(self, value, max_distance):
+        matches = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node_value, node_items, children = nodes.pop()
+            distance = get_distance(value, node_value)
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in node_items)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return matches
+
+
+# The image hashes of every receipt, held in memory by each process. Image hashes are only ever set on new receipts,
+# so the index just reads receipts newer than the last one it has seen whose image had finished processing (or had
+# failed, or had been processing for longer than PROCESSING_TIMEOUT). Bumping the "receipt_image_index" version (as
+# build_receipt_image_index does) makes every process rebuild it.
+class ReceiptImageIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.tree = BKTree()
+        self.indexed_ids = set()
+        self.complete_up_to_id = 0
+
+    def sync(self):
+        version = get_version("receipt_image_index", "all")
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.tree = BKTree()
+                self.indexed_ids = set()
+                self.complete_up_to_id = 0
+            receipts = Receipt.objects.filter(pk__gt=self.complete_up_to_id).order_by("pk") \
+                .values_list("pk", "image_hash", "image_status", "creation_datetime")
+            stuck_before = timezone.now() - PROCESSING_TIMEOUT
+            complete = True
+            for receipt_id, image_hash, image_status, creation_datetime in receipts:
+                if image_hash and receipt_id not in self.indexed_ids:
+                    self.tree.add(int(image_hash, 16), receipt_id)
+                    self.indexed_ids.add(receipt_id)
+                # Receipts after one that's still processing are read again next time, until it has finished
+                if image_status == "1" and creation_datetime > stuck_before:
+                    complete = False
+                if complete:
+                    self.complete_up_to_id = receipt_id
+
+    def search(self, image_hash, max_distance=DUPLICATE_DISTANCE):
+        with self.lock:
+            return self.tree.search(int(image_hash, 16), max_distance)
+
+
+receipt_image_index = ReceiptImageIndex()
+
+
+def reset_receipt_image_index():
+    bump_version("receipt_image_index", "all")
+
+
+# Returns {receipt: [other receipts whose images look the same]} for the given receipts that have any. Matches are
+# checked against the database, as the index may still hold receipts that have since been deleted.
+def find_duplicate_receipts(receipts):
+    receipts = [receipt for receipt in receipts if receipt.image_hash]
+    if not receipts:
+        return {}
+    receipt_image_index.sync()
+    matching_ids = {}
+    for receipt in receipts:
+        matching_ids[receipt] = {receipt_id for distance, receipt_id in receipt_image_index.search(receipt.image_hash)
+                                 if receipt_id != receipt.pk}
+    all_matching_ids = set().union(*matching_ids.values())
+    if not all_matching_ids:
+        return {}
+    matches = Receipt.objects.filter(pk__in=all_matching_ids).select_related("claim", "claim__owner").in_bulk()
+    duplicates = {}
+    for receipt, receipt_ids in matching_ids.items():
+        duplicate_receipts = [matches[receipt_id] for receipt_id in receipt_ids if receipt_id in matches]
+        if duplicate_receipts:
+            duplicates[receipt] = sorted(duplicate_receipts, key=lambda duplicate: duplicate.creation_datetime)
+    return duplicates
@@ -4,7 +4,7 @@ from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from django.utils import timezone as django_timezone
 
-from expensesapp.models import Currency
+from expensesapp.reference_data import category_table, currency_table
 
 
 class AccountEditForm(forms.Form):
@@ -16,13 +16,7 @@ class AccountEditForm(forms.Form):
         current_default_currency = kwargs.pop("default_currency")
         current_sub_email = kwargs.pop("substitute_email")
         super().__init__(*args, **kwargs)
-        choices = []
-        for currency in Currency.objects.order_by("name"):
-            if currency == current_default_currency:
-                choices.insert(0, (currency.name, str(currency)))
-            else:
-                choices.append((currency.name, str(currency)))
-        self.fields["default_currency"].choices = choices
+        self.fields["default_currency"].choices = currency_table.get_labelled_choices(first=current_default_currency)
         self.fields["substitute_email"].initial = current_sub_email
 
     def clean_substitute_email(self):
@@ -46,13 +40,7 @@ class ClaimNewForm(forms.Form):
     def __init__(self, *args, **kwargs):
         default_currency = kwargs.pop("default_currency")
         super().__init__(*args, **kwargs)
-        choices = []
-        for currency in Currency.objects.order_by("name"):
-            if currency == default_currency:
-                choices.insert(0, (currency.name, str(currency)))
-            else:
-                choices.append((currency.name, str(currency)))
-        self.fields["currency"].choices = choices
+        self.fields["currency"].choices = currency_table.get_labelled_choices(first=default_currency)
 
 
 class ClaimEditForm(forms.Form):
@@ -73,8 +61,8 @@ class ClaimDeleteForm(forms.Form):
         self.fields["claim"].initial = reference
 
 
-class ReceiptNewForm(forms.Form):
-    claim = forms.CharField(widget=forms.HiddenInput)
+# The fields for a single new receipt, as used by both the single and the batch upload pages
+class ReceiptLineForm(forms.Form):
     date_incurred = forms.DateField(widget=forms.DateInput(format='%Y-%m-%d'), initial=django_timezone.now())
     category = forms.ChoiceField(choices=[None])
     amount = forms.FloatField()
@@ -83,11 +71,16 @@ class ReceiptNewForm(forms.Form):
     file = forms.ImageField()
 
     def __init__(self, *args, **kwargs):
-        claim_ref = kwargs.pop("claim_ref")
-        categories = kwargs.pop("categories")
+        self.upload_errors = kwargs.pop("upload_errors", {})
         super().__init__(*args, **kwargs)
-        self.fields["claim"].initial = claim_ref
-        self.fields["category"].choices = queryset_to_choices(categories)
+        self.fields["category"].choices = category_table.get_choices()
+
+    # Whether nothing has been entered, apart from the date and category that are filled in to start with. A file that
+    # the upload handler turned away still counts as something entered, so that its line is shown with the reason.
+    def is_blank(self):
+        if self.add_prefix("file") in self.upload_errors:
+            return False
+        return not any(self[field_name].data for field_name in ["amount", "vat", "description", "file"])
 
     def clean(self):
         cleaned_data = super().clean()
@@ -99,6 +92,12 @@ class ReceiptNewForm(forms.Form):
             if vat >= amount:
                 raise ValidationError("Enter a value less than Amount.")
 
+        # Give the reason the upload handler turned the image away, instead of saying that none was uploaded
+        upload_error = self.upload_errors.get(self.add_prefix("file"))
+        if upload_error:
+            self.errors.pop("file", None)
+            self.add_error("file", upload_error)
+
         return cleaned_data
 
     def clean_amount(self):
@@ -139,6 +138,19 @@ class ReceiptNewForm(forms.Form):
             return data
 
 
+class ReceiptNewForm(ReceiptLineForm):
+    claim = forms.CharField(widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        claim_ref = kwargs.pop("claim_ref")
+        super().__init__(*args, **kwargs)
+        self.fields["claim"].initial = claim_ref
+
+
+# Up to 50 receipts can be uploaded at once. Lines left blank are ignored.
+ReceiptBatchFormSet = forms.formset_factory(ReceiptLineForm, max_num=50, validate_max=True)
+
+
 class ReceiptEditForm(forms.Form):
     date_incurred = forms.DateField(widget=forms.DateInput(format='%Y-%m-%d'), initial=django_timezone.now())
     category = forms.ChoiceField(choices=[None])
@@ -147,14 +159,13 @@ class ReceiptEditForm(forms.Form):
     description = forms.CharField(max_length=50, required=False)
 
     def __init__(self, *args, **kwargs):
-        categories = kwargs.pop("categories")
         date_incurred = kwargs.pop("date_incurred")
         category = kwargs.pop("category")
         amount = kwargs.pop("amount")
         vat = kwargs.pop("vat")
         description = kwargs.pop("description")
         super().__init__(*args, **kwargs)
-        self.fields["category"].choices = queryset_to_choices(categories)
+        self.fields["category"].choices = category_table.get_choices()
         self.fields["date_incurred"].initial = date_incurred
         self.fields["category"].initial = category
         self.fields["amount"].initial = "{0:0.2f}".format(amount)
@@ -240,14 +251,3 @@ class ClaimApproveForm(forms.Form):
         reference = kwargs.pop("claim_ref")
         super().__init__(*args, **kwargs)
         self.fields["claim"].initial = reference
-
-
-# From a queryset, build a list of tuples, suitable for a form field's 'choices' attribute.
-# Note: The entities must have a 'name' field. Assumes data to send is the same as visible choices.
-def queryset_to_choices(queryset):
-    output_list = []
-    for entity in queryset:
-        entity_string = entity.name
-        entity_tuple = (entity_string, entity_string)
-        output_list.append(entity_tuple)
-    return output_list
\ No newline at end of file
@@ -0,0 +1,288 @@
+import datetime
+import logging
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from storages.utils import clean_name
+
+from expensesapp.admission import get_upload_gate
+from expensesapp.custom import handle_uploaded_file
+from expensesapp.duplicates import find_duplicate_receipts
+from expensesapp.models import Claim, FileDeletion, Receipt, ReceiptImageBlob, ReceiptImageJob
+from expensesapp.receipt_images import forget_derivatives
+from expensesapp.storage import time_storage_operation
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = datetime.timedelta(seconds=30)
+MAX_RETRY_DELAY = datetime.timedelta(days=1)
+LOCK_DURATION = datetime.timedelta(minutes=5)
+# Seconds a job waits for a slot in the upload gate, which is well within its lock duration
+SLOT_TIMEOUT = 60
+# Where uploads wait in the media storage for their jobs to run
+SPOOL_PREFIX = "spool"
+
+executor = None
+executor_lock = threading.Lock()
+
+
+# Saves the upload to the media storage and queues it to be resized and stored once the current transaction commits,
+# so the request can return without waiting for the image to be processed. Any web or worker process can then run the
+# job, as the upload isn't left on the disk of the one that received it.
+def enqueue_receipt_image(receipt, uploaded_file):
+    return enqueue_receipt_images([(receipt, uploaded_file)])[0]
+
+
+# Queues the images for several receipts at once, as (receipt, uploaded file) pairs
+def enqueue_receipt_images(receipt_files):
+    storage = Receipt._meta.get_field("file").storage
+    jobs = []
+    for receipt, uploaded_file in receipt_files:
+        spool_path = storage.save(get_spool_name(uploaded_file.name), uploaded_file)
+        receipt.image_status = "1"
+        jobs.append(ReceiptImageJob.create(receipt, spool_path, uploaded_file.name))
+    Receipt.objects.filter(pk__in=[job.receipt_id for job in jobs]).update(image_status="1")
+    ReceiptImageJob.objects.bulk_create(jobs)
+    transaction.on_commit(partial(start_processing, len(jobs)))
+    return jobs
+
+
+# Spooled uploads are named after the time they were saved, so that orphaned ones can be found without asking the
+# storage for each file's age (see remove_orphaned_spool_files)
+def get_spool_name(file_name):
+    return "{0}/{1}_{2}{3}".format(SPOOL_PREFIX, int(time.time()), secrets.token_hex(8),
+                                   os.path.splitext(file_name)[1].lower())
+
+
+# Processes due jobs on the worker pool, or straight away if the pool is turned off (RECEIPT_IMAGE_WORKERS = 0). Each
+# worker keeps taking jobs until there are none left, so a batch is spread over up to RECEIPT_IMAGE_WORKERS threads.
+def start_processing(job_count=1):
+    if settings.RECEIPT_IMAGE_WORKERS == 0:
+        process_due_jobs()
+    else:
+        for worker_num in range(min(job_count, settings.RECEIPT_IMAGE_WORKERS)):
+            get_executor().submit(process_due_jobs_in_thread)
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=settings.RECEIPT_IMAGE_WORKERS,
+                                          thread_name_prefix="receipt-images")
+        return executor
+
+
+def process_due_jobs_in_thread():
+    try:
+        process_due_jobs()
+    except Exception:
+        logger.exception("Receipt image worker stopped unexpectedly")
+    finally:
+        connection.close()
+
+
+# Runs jobs until none are due, returning how many were run
+def process_due_jobs():
+    job_count = 0
+    job = claim_next_job()
+    while job:
+        run_job(job)
+        job_count += 1
+        job = claim_next_job()
+    return job_count
+
+
+# Marks the next due job as running, so no other worker takes it. Jobs that have been running for longer than the
+# lock duration are assumed to belong to a worker that died, and are claimed again.
+def claim_next_job():
+    now = timezone.now()
+    due = Q(status="1", run_after_datetime__lte=now) | Q(status="2", locked_until_datetime__lt=now)
+    for job_id in ReceiptImageJob.objects.filter(due).order_by("run_after_datetime").values_list("id", flat=True)[:10]:
+        claimed = ReceiptImageJob.objects.filter(due, pk=job_id).update(
+            status="2", locked_until_datetime=now + LOCK_DURATION, attempts=F("attempts") + 1)
+        if claimed:
+            return ReceiptImageJob.objects.select_related("receipt").get(pk=job_id)
+    return None
+
+
+# Decoding and encoding images takes one of the upload gate's slots, so that the images being processed by every
+# worker on the machine count towards the same limit as the uploads themselves. A job that waits too long for a slot
+# is put back in the queue without counting as an attempt.
+def run_job(job):
+    with get_upload_gate().hold(SLOT_TIMEOUT) as admitted:
+        if admitted:
+            process_job(job)
+        else:
+            ReceiptImageJob.objects.filter(pk=job.pk).update(
+                status="1", run_after_datetime=timezone.now() + RETRY_DELAY, attempts=F("attempts") - 1)
+
+
+def process_job(job):
+    receipt = job.receipt
+    storage = Receipt._meta.get_field("file").storage
+    new_file_names = []
+    try:
+        # Any reference taken to an already stored image is undone if the receipt can't be saved
+        with transaction.atomic(), storage.open(job.spool_path, "rb") as spooled_file:
+            handle_uploaded_file(File(spooled_file, name=job.file_name), receipt, new_file_names)
+            receipt.image_status = "2"
+            receipt.save(update_fields=["file", "image_status", "image_hash"])
+    except Exception as error:
+        discard_unregistered_files(new_file_names)
+        if not Receipt.objects.filter(pk=receipt.pk).exists():
+            # The receipt was deleted while its image was being processed
+            FileDeletion.enqueue([job.spool_path])
+            return
+        logger.exception("Failed to process image for %s (attempt %d)", receipt, job.attempts)
+        job.last_error = repr(error)
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = "4"
+            Receipt.objects.filter(pk=receipt.pk).update(image_status="3")
+            FileDeletion.enqueue([job.spool_path])
+        else:
+            job.status = "1"
+            job.run_after_datetime = timezone.now() + RETRY_DELAY * 2 ** (job.attempts - 1)
+        job.save(update_fields=["status", "run_after_datetime", "last_error"])
+    else:
+        job.status = "3"
+        job.save(update_fields=["status"])
+        FileDeletion.enqueue([job.spool_path])
+        check_for_duplicates(receipt)
+
+
+# Claims are checked for duplicate receipts when they're submitted, which misses receipts whose images were still
+# being processed, so those are checked as soon as they're ready
+def check_for_duplicates(receipt):
+    try:
+        claim = Claim.objects.filter(pk=receipt.claim_id).first()
+        if claim and claim.status != "1" and not claim.possible_duplicates and find_duplicate_receipts([receipt]):
+            claim.possible_duplicates = True
+            claim.save(update_fields=["possible_duplicates"])
+    except Exception:
+        logger.exception("Failed to check %s for duplicates", receipt)
+
+
+# Queues the files a failed job stored to be deleted, unless they were registered as blobs all the same. Images the
+# job only took a reference to are left alone, as the rollback has already given the reference back.
+def discard_unregistered_files(file_names):
+    registered_names = set(ReceiptImageBlob.objects.filter(file_name__in=file_names)
+                           .values_list("file_name", flat=True))
+    unregistered_names = [file_name for file_name in file_names if file_name not in registered_names]
+    if unregistered_names:
+        FileDeletion.enqueue([deleted_name for file_name in unregistered_names
+                              for deleted_name in [file_name] + forget_derivatives(file_name)])
+
+
+# Queues spooled uploads that no job refers to any more (e.g. because the receipt was deleted before its image was
+# processed, or the upload's transaction rolled back) to be deleted. Recent files are left alone, as their jobs may
+# not have been committed yet.
+def remove_orphaned_spool_files(min_age=60 * 60):
+    storage = Receipt._meta.get_field("file").storage
+    try:
+        spool_names = storage.listdir(SPOOL_PREFIX)[1]
+    except FileNotFoundError:
+        return
+    spool_paths = {"{0}/{1}".format(SPOOL_PREFIX, spool_name) for spool_name in spool_names
+                   if spool_name.split("_")[0].isdigit() and int(spool_name.split("_")[0]) < time.time() - min_age}
+    spool_paths -= set(ReceiptImageJob.objects.filter(spool_path__in=spool_paths, status__in=["1", "2"])
+                       .values_list("spool_path", flat=True))
+    spool_paths -= set(FileDeletion.objects.filter(file_name__in=spool_paths).values_list("file_name", flat=True))
+    if spool_paths:
+        FileDeletion.enqueue(sorted(spool_paths))
+
+
+# Deletes queued files on the worker pool, or straight away if the pool is turned off
+def start_file_deletions():
+    if settings.RECEIPT_IMAGE_WORKERS == 0:
+        process_due_file_deletions()
+    else:
+        get_executor().submit(process_due_file_deletions_in_thread)
+
+
+def process_due_file_deletions_in_thread():
+    try:
+        process_due_file_deletions()
+    except Exception:
+        logger.exception("File deletion worker stopped unexpectedly")
+    finally:
+        connection.close()
+
+
+# Deletes due files in batches until none are left, returning how many were deleted. Files that couldn't be deleted
+# are tried again later, waiting twice as long after each failure.
+def process_due_file_deletions(batch_size=1000):
+    deleted_count = 0
+    storage = Receipt._meta.get_field("file").storage
+    deletions = claim_file_deletions(batch_size)
+    while deletions:
+        errors = delete_files(storage, sorted({deletion.file_name for deletion in deletions}))
+        FileDeletion.objects.filter(pk__in=[deletion.pk for deletion in deletions
+                                            if deletion.file_name not in errors]).delete()
+        for deletion in deletions:
+            if deletion.file_name in errors:
+                logger.warning("Failed to delete %s (attempt %d): %s", deletion.file_name, deletion.attempts,
+                               errors[deletion.file_name])
+                deletion.last_error = errors[deletion.file_name]
+                deletion.run_after_datetime = timezone.now() + min(RETRY_DELAY * 2 ** (deletion.attempts - 1),
+                                                                   MAX_RETRY_DELAY)
+                deletion.save(update_fields=["run_after_datetime", "last_error"])
+        deleted_count += len(deletions) - sum(deletion.file_name in errors for deletion in deletions)
+        deletions = claim_file_deletions(batch_size)
+    return deleted_count
+
+
+# Takes a batch of due deletions, putting them off for the lock duration so that no other worker takes them too.
+# Rows locked by another worker's claim are skipped where the database supports it.
+def claim_file_deletions(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        deletions = list(FileDeletion.objects.select_for_update(skip_locked=True)
+                         .filter(run_after_datetime__lte=now).order_by("run_after_datetime")[:batch_size])
+        FileDeletion.objects.filter(pk__in=[deletion.pk for deletion in deletions]) \
+            .update(run_after_datetime=now + LOCK_DURATION, attempts=F("attempts") + 1)
+    for deletion in deletions:
+        deletion.attempts += 1
+    return deletions
+
+
+# Deletes files from storage, returning {file name: error} for any that couldn't be deleted. S3 can delete up to 1000
+# objects in one request, and other storage backends delete the files one at a time.
+def delete_files(storage, file_names):
+    if hasattr(storage, "bucket"):
+        return delete_s3_objects(storage, file_names)
+    errors = {}
+    for file_name in file_names:
+        try:
+            storage.delete(file_name)
+        except Exception as error:
+            errors[file_name] = repr(error)
+    return errors
+
+
+def delete_s3_objects(storage, file_names):
+    errors = {}
+    for start in range(0, len(file_names), 1000):
+        batch_names = file_names[start:start + 1000]
+        # Object keys are worked out the same way as in S3Boto3Storage.delete()
+        keys = {storage._normalize_name(clean_name(file_name)): file_name for file_name in batch_names}
+        try:
+            with time_storage_operation("delete_objects"):
+                response = storage.bucket.delete_objects(
+                    Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+        except Exception as error:
+            errors.update({file_name: repr(error) for file_name in batch_names})
+            continue
+        for error in response.get("Errors", []):
+            errors[keys.get(error["Key"], error["Key"])] = "{0}: {1}".format(error.get("Code"), error.get("Message"))
+    return errors
@@ -0,0 +1,74 @@
+import itertools
+import os
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageDraw, ImageFilter, features
+
+from expensesapp.custom import load_receipt_image
+from expensesapp.receipt_images import RECEIPT_IMAGE_COLOUR_MODES, RECEIPT_IMAGE_FORMATS, encode_receipt_image
+
+
+class Command(BaseCommand):
+    help = ("Compares the stored size and encode time of receipt images for each combination of format, quality and "
+            "colour mode, to help choose the RECEIPT_IMAGE_* settings.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", help="Directory of sample receipt images to use instead of generated ones.")
+        parser.add_argument("--count", type=int, default=5, help="Number of receipts to generate.")
+        parser.add_argument("--formats", nargs="+", default=list(RECEIPT_IMAGE_FORMATS), choices=RECEIPT_IMAGE_FORMATS)
+        parser.add_argument("--qualities", type=int, nargs="+", default=[95, 80, 60])
+        parser.add_argument("--colour-modes", nargs="+", default=RECEIPT_IMAGE_COLOUR_MODES,
+                            choices=RECEIPT_IMAGE_COLOUR_MODES)
+
+    def handle(self, *args, **options):
+        # Images are decoded once up front, as stored images are, so only encoding is timed
+        if options["images"]:
+            samples = []
+            for file_name in sorted(os.listdir(options["images"])):
+                with open(os.path.join(options["images"], file_name), "rb") as sample_file:
+                    samples.append(load_receipt_image(sample_file))
+        else:
+            samples = [create_sample_receipt(seed) for seed in range(options["count"])]
+
+        self.stdout.write("{0:<10} {1:>7} {2:<10} {3:>11} {4:>10} {5:>10}".format(
+            "format", "quality", "colour", "progressive", "KB/image", "ms/image"))
+        # The original setting (baseline JPEG at quality 95, in colour) comes first, for comparison
+        settings = [("jpeg", 95, "colour", False)]
+        settings += [(image_format, quality, colour_mode, True) for image_format, quality, colour_mode
+                     in itertools.product(options["formats"], options["qualities"], options["colour_modes"])]
+        for image_format, quality, colour_mode, progressive in settings:
+            feature = RECEIPT_IMAGE_FORMATS[image_format][2]
+            if feature and not features.check(feature):
+                self.stdout.write("{0:<10} not supported by this build of Pillow".format(image_format))
+                continue
+            total_bytes = 0
+            start_time = time.perf_counter()
+            for sample in samples:
+                blob, extension = encode_receipt_image(sample, image_format=image_format, quality=quality,
+                                                       colour_mode=colour_mode, progressive=progressive)
+                total_bytes += blob.getbuffer().nbytes
+            elapsed_time = time.perf_counter() - start_time
+            self.stdout.write("{0:<10} {1:>7} {2:<10} {3:>11} {4:>10.1f} {5:>10.1f}".format(
+                image_format, quality, colour_mode, ("yes" if progressive else "no") if image_format == "jpeg" else "-",
+                total_bytes / len(samples) / 1024, elapsed_time / len(samples) * 1000))
+
+
+# Draws something like a photographed till receipt: lines of dark text on a slightly uneven paper background, at the
+# size uploads are stored at
+def create_sample_receipt(seed):
+    randomiser = random.Random(seed)
+    width, height = 560, 900
+    image = Image.new("RGB", (width, height), (236, 232, 222))
+    draw = ImageDraw.Draw(image)
+    y = 30
+    while y < height - 30:
+        line = "".join(randomiser.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ 0123456789.,-£") for _ in range(40))
+        draw.text((30, y), line, fill=(40, 40, 45))
+        draw.text((width - 90, y), "{0:.2f}".format(randomiser.uniform(0, 100)), fill=(40, 40, 45))
+        y += randomiser.choice([18, 18, 18, 36])
+    shading = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    image = Image.blend(image, shading, 0.08)
+    noise = Image.effect_noise((width, height), 12).convert("RGB")
+    return Image.blend(image, noise, 0.05).filter(ImageFilter.SMOOTH)
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageOps
+
+from expensesapp.custom import load_receipt_image
+
+
+class Command(BaseCommand):
+    help = ("Measures the time and peak memory taken to decode and resize receipt images of several sizes, with and "
+            "without reduced-resolution decoding.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", help="Directory of sample images to use instead of generated ones.")
+        parser.add_argument("--megapixels", type=int, nargs="+", default=[2, 12, 24, 48],
+                            help="Sizes of the generated sample JPEGs, in megapixels.")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as sample_dir:
+            if options["images"]:
+                sample_paths = [os.path.join(options["images"], file_name)
+                                for file_name in sorted(os.listdir(options["images"]))]
+            else:
+                sample_paths = [create_sample_jpeg(sample_dir, megapixels) for megapixels in options["megapixels"]]
+
+            # Each measurement runs in a fresh process, so that its peak memory isn't hidden by an earlier one
+            context = multiprocessing.get_context("spawn")
+            self.stdout.write("{0:<36} {1:>12} {2:>12} {3:>14} {4:>14}".format(
+                "image", "full (ms)", "reduced (ms)", "full (MB)", "reduced (MB)"))
+            for sample_path in sample_paths:
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    full_time, full_memory = pool.apply(measure, (sample_path, decode_full_resolution))
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    reduced_time, reduced_memory = pool.apply(measure, (sample_path, load_receipt_image))
+                with Image.open(sample_path) as image:
+                    description = "{0} ({1}x{2})".format(os.path.basename(sample_path), *image.size)
+                self.stdout.write("{0:<36} {1:>12.0f} {2:>12.0f} {3:>14.1f} {4:>14.1f}".format(
+                    description, full_time * 1000, reduced_time * 1000, full_memory / 1024, reduced_memory / 1024))
+
+
+def create_sample_jpeg(sample_dir, megapixels):
+    width = int((megapixels * 1000000 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    sample_path = os.path.join(sample_dir, "sample_{0}mp.jpeg".format(megapixels))
+    # Noise makes the JPEG decoder do a realistic amount of work
+    Image.effect_noise((width, height), 64).convert("RGB").save(sample_path, "JPEG", quality=90)
+    return sample_path
+
+
+# The decode used before reduced-resolution decoding, for comparison
+def decode_full_resolution(file, target_pixel_count=500000):
+    image = Image.open(file)
+    image.load()
+    width, height = image.size
+    if width * height > target_pixel_count:
+        resize_ratio = (target_pixel_count / (width * height)) ** 0.5
+        image = image.resize((round(width * resize_ratio), round(height * resize_ratio)), Image.Resampling.LANCZOS)
+    return ImageOps.exif_transpose(image)
+
+
+# Returns the time taken and the growth in peak resident memory (in KB) for loading one image
+def measure(sample_path, load_function):
+    baseline_memory = get_peak_memory()
+    start_time = time.perf_counter()
+    with open(sample_path, "rb") as sample_file:
+        load_function(sample_file)
+    elapsed_time = time.perf_counter() - start_time
+    return elapsed_time, get_peak_memory() - baseline_memory
+
+
+# Linux reports the peak for the current program in /proc (ru_maxrss can be carried over from the parent process)
+def get_peak_memory():
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,99 @@
+import logging
+import os
+import socket
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from expensesapp.storage import LocalReceiptStorage, ReceiptStorage
+
+
+class Command(BaseCommand):
+    help = ("Compares the time S3Boto3Storage, ReceiptStorage and LocalReceiptStorage take to save, check, read and "
+            "delete files from several threads at once. By default S3 is stood in for by a local moto server "
+            "(pip install 'moto[server]'), so nothing is sent over the network.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--endpoint-url", help="S3-compatible server to use instead of starting moto.")
+        parser.add_argument("--bucket", default="expensesapp-benchmark")
+        parser.add_argument("--count", type=int, default=100, help="Files to store with each storage class.")
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--sizes", type=int, nargs="+", default=[300, 20000],
+                            help="File sizes in KB. Files bigger than AWS_S3_MULTIPART_THRESHOLD are sent in parts.")
+
+    def handle(self, *args, **options):
+        server = None
+        endpoint_url = options["endpoint_url"]
+        if endpoint_url is None:
+            try:
+                from moto.server import ThreadedMotoServer
+            except ImportError:
+                raise CommandError("moto isn't installed. Install it with pip install 'moto[server]', or pass "
+                                   "--endpoint-url.")
+            # moto's server logs every request
+            logging.getLogger("werkzeug").setLevel(logging.ERROR)
+            port = get_free_port()
+            server = ThreadedMotoServer(port=port, verbose=False)
+            server.start()
+            endpoint_url = "http://127.0.0.1:{0}".format(port)
+
+        storage_settings = {"endpoint_url": endpoint_url, "bucket_name": options["bucket"], "region_name": "us-east-1",
+                            "access_key": "benchmark", "secret_key": "benchmark"}
+        client = boto3.client("s3", endpoint_url=endpoint_url, region_name="us-east-1", aws_access_key_id="benchmark",
+                              aws_secret_access_key="benchmark")
+        try:
+            client.create_bucket(Bucket=options["bucket"])
+        except client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+        try:
+            self.stdout.write("{0:<20} {1:>8} {2:<8} {3:>9} {4:>9} {5:>9}".format(
+                "storage", "KB", "op", "ms/op", "p95 ms", "files/s"))
+            for size in options["sizes"]:
+                content = os.urandom(size * 1024)
+                for storage_name, storage_class in [("S3Boto3Storage", S3Boto3Storage),
+                                                    ("ReceiptStorage", ReceiptStorage)]:
+                    storage = storage_class(**storage_settings)
+                    self.run_benchmark(storage_name, storage, content, size, options["count"], options["threads"])
+                with tempfile.TemporaryDirectory() as location:
+                    self.run_benchmark("LocalReceiptStorage", LocalReceiptStorage(location=location), content, size,
+                                       options["count"], options["threads"])
+        finally:
+            if server is not None:
+                server.stop()
+
+    def run_benchmark(self, storage_name, storage, content, size, count, threads):
+        names = ["benchmark/{0}/{1}kb/{2}.bin".format(storage_name, size, num) for num in range(count)]
+        operations = [
+            ("save", lambda name: storage.save(name, ContentFile(content))),
+            ("exists", storage.exists),
+            ("read", lambda name: storage.open(name).read()),
+            ("url", storage.url),
+            ("delete", storage.delete),
+        ]
+        for operation, function in operations:
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(threads) as executor:
+                timings = list(executor.map(lambda name: time_call(function, name), names))
+            elapsed_time = time.perf_counter() - start_time
+            self.stdout.write("{0:<20} {1:>8} {2:<8} {3:>9.1f} {4:>9.1f} {5:>9.0f}".format(
+                storage_name, size, operation, statistics.mean(timings) * 1000,
+                statistics.quantiles(timings, n=20)[-1] * 1000, count / elapsed_time))
+
+
+def time_call(function, *args):
+    start_time = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start_time
+
+
+def get_free_port():
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from expensesapp.custom import load_receipt_image
+from expensesapp.duplicates import receipt_image_index, reset_receipt_image_index
+from expensesapp.models import Receipt, ReceiptImageBlob
+from expensesapp.receipt_images import get_image_hash
+
+
+class Command(BaseCommand):
+    help = ("Computes the image hashes used to find duplicate receipts for receipts that don't have one yet, then "
+            "makes every process rebuild its duplicate receipt index.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Recompute the hashes of every receipt.")
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        receipts = Receipt.objects.exclude(file=None).exclude(file="").order_by("pk")
+        if not options["all"]:
+            receipts = receipts.filter(image_hash=None)
+
+        # Receipts that share a stored image (see ReceiptImageBlob) only need it to be read once
+        image_hashes = {}
+        batch = []
+        updated_count = 0
+        failed_count = 0
+        for receipt in receipts.only("pk", "reference", "file").iterator(chunk_size=options["batch_size"]):
+            if receipt.file.name not in image_hashes:
+                try:
+                    with receipt.file.open("rb") as image_file:
+                        image_hashes[receipt.file.name] = get_image_hash(load_receipt_image(image_file, 16384))
+                except Exception as error:
+                    self.stderr.write("Couldn't read the image for {0}: {1!r}".format(receipt.reference, error))
+                    image_hashes[receipt.file.name] = None
+                    failed_count += 1
+            receipt.image_hash = image_hashes[receipt.file.name]
+            if receipt.image_hash:
+                batch.append(receipt)
+            if len(batch) >= options["batch_size"]:
+                updated_count += save_image_hashes(batch)
+                batch = []
+        updated_count += save_image_hashes(batch)
+        self.stdout.write("Hashed {0} receipts ({1} images, {2} unreadable).".format(
+            updated_count, len(image_hashes), failed_count))
+
+        reset_receipt_image_index()
+        start_time = time.perf_counter()
+        receipt_image_index.sync()
+        build_time = time.perf_counter() - start_time
+        self.stdout.write("Indexed {0} receipts in {1:.0f} ms.".format(receipt_image_index.tree.size,
+                                                                        build_time * 1000))
+
+        sample_hashes = [image_hash for image_hash in image_hashes.values() if image_hash][:1000]
+        if sample_hashes:
+            start_time = time.perf_counter()
+            for image_hash in sample_hashes:
+                receipt_image_index.search(image_hash)
+            search_time = (time.perf_counter() - start_time) / len(sample_hashes)
+            self.stdout.write("Average search time: {0:.3f} ms.".format(search_time * 1000))
+
+
+def save_image_hashes(receipts):
+    Receipt.objects.bulk_update(receipts, ["image_hash"])
+    for file_name, image_hash in {receipt.file.name: receipt.image_hash for receipt in receipts}.items():
+        ReceiptImageBlob.objects.filter(file_name=file_name, image_hash=None).update(image_hash=image_hash)
+    return len(receipts)
@@ -0,0 +1,86 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from expensesapp.models import Claim, Feedback, Receipt, User
+from expensesapp.pagination import KeysetPaginator
+
+
+class Command(BaseCommand):
+    help = "Runs EXPLAIN on the app's main queries and fails if any of them scans a whole table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--verbose-plans", action="store_true", help="Print the full plan of every query.")
+
+    def handle(self, *args, **options):
+        failures = []
+        for name, queryset in get_main_queries():
+            plan = explain(queryset)
+            full_scans = find_full_scans(plan)
+            if full_scans:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR("FULL SCAN  {0}: {1}".format(name, "; ".join(full_scans))))
+            else:
+                self.stdout.write("ok         {0}".format(name))
+            if options["verbose_plans"]:
+                self.stdout.write(plan)
+
+        if failures:
+            raise CommandError("{0} queries scan a whole table: {1}".format(len(failures), ", ".join(failures)))
+
+
+# The queries behind the list and detail pages. The values used don't need to exist, as only the plans are checked.
+def get_main_queries():
+    user = User(pk=1)
+    claim_paginator = KeysetPaginator(Claim.objects.filter(owner=user), ["-status_update_datetime", "-id"], 15)
+    pending_paginator = KeysetPaginator(Claim.objects.pending_for_manager(user, scope="all"),
+                                        ["-submission_datetime", "-id"], 15)
+    cursor_claim = Claim(pk=1, status_update_datetime="2022-01-01T00:00:00+00:00",
+                         submission_datetime="2022-01-01T00:00:00+00:00")
+    return [
+        ("claim by reference", Claim.objects.filter(reference="C0000000")),
+        ("receipt by reference", Receipt.objects.filter(reference="R000000000")),
+        ("your expenses, all", claim_paginator.queryset.order_by(*claim_paginator.ordering)[:15]),
+        ("your expenses, by status", Claim.objects.filter(owner=user, status="1")
+            .order_by("-status_update_datetime", "-id")[:15]),
+        ("your expenses, next page", claim_paginator.queryset
+            .filter(claim_paginator.seek_condition(claim_paginator.get_key(cursor_claim)))
+            .order_by(*claim_paginator.ordering)[:15]),
+        ("claim counts by status", Claim.objects.filter(owner=user).order_by().values("status")
+            .annotate(count=Count("id"))),
+        ("pending claims, own team", Claim.objects.pending_for_manager(user, scope="own")
+            .order_by("-submission_datetime", "-id")[:15]),
+        ("pending claims, other teams", Claim.objects.pending_for_manager(user, scope="substitute")
+            .order_by("-submission_datetime", "-id")[:15]),
+        ("pending claims, all teams", pending_paginator.queryset.order_by(*pending_paginator.ordering)[:15]),
+        ("pending claim access check", Claim.objects.pending_for_manager(user, scope="all").filter(pk=1)),
+        ("claim receipts", Receipt.objects.filter(claim_id=1).order_by("creation_datetime")),
+        ("latest claim feedback", Feedback.objects.filter(claim_id=1).order_by("-creation_datetime")[:1]),
+        ("receipt image index sync", Receipt.objects.filter(pk__gt=1).order_by("pk")
+            .values_list("pk", "image_hash", "image_status", "creation_datetime")),
+    ]
+
+
+def explain(queryset):
+    if connection.vendor == "postgresql":
+        # Small tables are always cheaper to scan, so rule sequential scans out to see which indexes can be used
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            return queryset.explain()
+    return queryset.explain()
+
+
+# Returns the lines of a query plan that read every row of a table
+def find_full_scans(plan):
+    full_scans = []
+    for line in plan.splitlines():
+        step = line.strip()
+        if connection.vendor == "sqlite":
+            if re.search(r"\bSCAN (?!CONSTANT ROW)", step):
+                full_scans.append(step)
+        elif "Seq Scan" in step:
+            full_scans.append(step)
+    return full_scans
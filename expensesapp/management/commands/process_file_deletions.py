@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from expensesapp.jobs import process_due_file_deletions
+
+
+class Command(BaseCommand):
+    help = "Deletes queued receipt image files from storage, including retries of failed attempts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="Keep checking for new deletions instead of exiting.")
+        parser.add_argument("--interval", type=float, default=60, help="Seconds between checks when looping.")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Files to delete in each batch.")
+
+    def handle(self, *args, **options):
+        while True:
+            deleted_count = process_due_file_deletions(options["batch_size"])
+            if deleted_count:
+                self.stdout.write("Deleted {0} files.".format(deleted_count))
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from expensesapp.jobs import process_due_jobs, remove_orphaned_spool_files
+
+
+class Command(BaseCommand):
+    help = "Processes queued receipt images, including retries of failed attempts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="Keep checking for new jobs instead of exiting.")
+        parser.add_argument("--interval", type=float, default=5, help="Seconds between checks when looping.")
+
+    def handle(self, *args, **options):
+        while True:
+            job_count = process_due_jobs()
+            if job_count:
+                self.stdout.write("Processed {0} receipt images.".format(job_count))
+            remove_orphaned_spool_files()
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+
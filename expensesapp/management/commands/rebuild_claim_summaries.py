@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expensesapp.models import Claim
+
+
+class Command(BaseCommand):
+    help = "Recalculates the receipt summary fields stored on each claim."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="Report claims with out of date summaries without changing them.")
+
+    def handle(self, *args, **options):
+        out_of_date_refs = []
+        for claim in Claim.objects.order_by("id").iterator():
+            if not claim.is_summary_current():
+                out_of_date_refs.append(claim.reference)
+                if not options["check"]:
+                    claim.refresh_summary()
+
+        if options["check"]:
+            if out_of_date_refs:
+                raise CommandError("{0} claim summaries are out of date: {1}".format(len(out_of_date_refs),
+                                                                                     ", ".join(out_of_date_refs)))
+            self.stdout.write("All claim summaries are up to date.")
+        else:
+            self.stdout.write("Rebuilt {0} claim summaries.".format(len(out_of_date_refs)))
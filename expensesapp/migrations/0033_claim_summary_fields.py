@@ -0,0 +1,59 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:39
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, Max, Min, Sum, When
+
+
+def populate_claim_summaries(apps, schema_editor):
+    Claim = apps.get_model("expensesapp", "Claim")
+    vat_percent = Case(When(amount__gt=0, then=F("vat") * 100 / F("amount")), default=0.0,
+                       output_field=models.FloatField())
+    for claim in Claim.objects.iterator():
+        summary = claim.receipts.aggregate(receipts_count=Count("id"), total_amount=Sum("amount"),
+                                           total_vat=Sum("vat"), highest_vat_percent=Max(vat_percent),
+                                           earliest_date_incurred=Min("date_incurred"),
+                                           latest_date_incurred=Max("date_incurred"))
+        summary["total_amount"] = summary["total_amount"] or 0
+        summary["total_vat"] = summary["total_vat"] or 0
+        Claim.objects.filter(pk=claim.pk).update(**summary)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0032_alter_receipt_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='claim',
+            name='earliest_date_incurred',
+            field=models.DateField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='highest_vat_percent',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='latest_date_incurred',
+            field=models.DateField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='receipts_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='total_amount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='claim',
+            name='total_vat',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(populate_claim_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:42
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0033_claim_summary_fields'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='back_url',
+        ),
+    ]
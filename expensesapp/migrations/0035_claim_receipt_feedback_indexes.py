@@ -0,0 +1,63 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:43
+
+import random
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# References used to be picked at random and then checked, so two claims or receipts can share one. The oldest keeps
+# it and the others are given new references in the same format, so the unique constraints below can be added.
+def reassign_duplicate_references(apps, schema_editor):
+    for model_name, prefix in [("Claim", "C"), ("Receipt", "R")]:
+        model = apps.get_model("expensesapp", model_name)
+        length = model._meta.get_field("reference").max_length - 1
+        duplicate_references = model.objects.order_by().values("reference").annotate(count=Count("id")) \
+            .filter(count__gt=1).values_list("reference", flat=True)
+        for reference in list(duplicate_references):
+            for row in model.objects.filter(reference=reference).order_by("id")[1:]:
+                new_reference = reference
+                while model.objects.filter(reference=new_reference).exists():
+                    new_reference = prefix + str(random.randint(10 ** (length - 1), 10 ** length - 1))
+                model.objects.filter(pk=row.pk).update(reference=new_reference)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0034_remove_user_back_url'),
+    ]
+
+    operations = [
+        migrations.RunPython(reassign_duplicate_references, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='claim',
+            name='reference',
+            field=models.CharField(max_length=8, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='receipt',
+            name='reference',
+            field=models.CharField(max_length=10, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['owner', 'status_update_datetime', 'id'], name='expensesapp_owner_i_51f6c8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['owner', 'status', 'status_update_datetime', 'id'], name='expensesapp_owner_i_4bba94_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='claim',
+            index=models.Index(fields=['status', 'submission_datetime', 'id'], name='expensesapp_status_188131_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feedback',
+            index=models.Index(fields=['claim', 'creation_datetime'], name='expensesapp_claim_i_0ecc0b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['claim', 'creation_datetime'], name='expensesapp_claim_i_e4d29d_idx'),
+        ),
+    ]
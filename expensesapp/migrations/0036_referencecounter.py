@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:44
+
+import secrets
+
+from django.db import migrations, models
+
+
+# References that already exist were picked at random, so new ones have to be checked against them
+def create_reference_counters(apps, schema_editor):
+    ReferenceCounter = apps.get_model("expensesapp", "ReferenceCounter")
+    for model_name in ("claim", "receipt"):
+        model = apps.get_model("expensesapp", model_name)
+        ReferenceCounter.objects.create(name="expensesapp." + model_name, key=secrets.token_hex(32),
+                                        check_existing=model.objects.exists())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0035_claim_receipt_feedback_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenceCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('next_value', models.BigIntegerField(default=0)),
+                ('key', models.CharField(max_length=64)),
+                ('check_existing', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.RunPython(create_reference_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_existing_images_ready(apps, schema_editor):
+    Receipt = apps.get_model("expensesapp", "Receipt")
+    Receipt.objects.exclude(file="").exclude(file=None).update(image_status="2")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0036_referencecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='image_status',
+            field=models.CharField(blank=True, choices=[('1', 'Processing'), ('2', 'Ready'), ('3', 'Failed')], default=None, max_length=1, null=True),
+        ),
+        migrations.CreateModel(
+            name='ReceiptImageJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spool_path', models.CharField(max_length=255)),
+                ('file_name', models.CharField(max_length=255)),
+                ('creation_datetime', models.DateTimeField()),
+                ('run_after_datetime', models.DateTimeField()),
+                ('locked_until_datetime', models.DateTimeField(blank=True, default=None, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('1', 'Queued'), ('2', 'Running'), ('3', 'Done'), ('4', 'Failed')], max_length=1)),
+                ('last_error', models.TextField(blank=True)),
+                ('receipt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='image_jobs', to='expensesapp.receipt')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after_datetime'], name='expensesapp_status_37ef8e_idx')],
+            },
+        ),
+        migrations.RunPython(mark_existing_images_ready, migrations.RunPython.noop),
+    ]
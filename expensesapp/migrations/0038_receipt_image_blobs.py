@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:53
+
+from django.db import migrations, models
+import expensesapp.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0037_receipt_image_status_receiptimagejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('file_name', models.CharField(max_length=255, unique=True)),
+                ('reference_count', models.PositiveIntegerField(default=1)),
+                ('creation_datetime', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='receipt',
+            name='file',
+            field=expensesapp.models.ReceiptImageField(blank=True, default=None, null=True, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0038_receipt_image_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='claim',
+            name='possible_duplicates',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='image_hash',
+            field=models.CharField(blank=True, default=None, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='receiptimageblob',
+            name='image_hash',
+            field=models.CharField(blank=True, default=None, max_length=16, null=True),
+        ),
+    ]
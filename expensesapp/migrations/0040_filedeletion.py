@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0039_receipt_image_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255)),
+                ('creation_datetime', models.DateTimeField()),
+                ('run_after_datetime', models.DateTimeField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['run_after_datetime'], name='expensesapp_run_aft_dc9e3d_idx'), models.Index(fields=['file_name'], name='expensesapp_file_na_94cab5_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expensesapp', '0040_filedeletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdmissionCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('admitted', models.BigIntegerField(default=0)),
+                ('rejected', models.BigIntegerField(default=0)),
+                ('wait_ms', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
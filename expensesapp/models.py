@@ -1,12 +1,40 @@
+from functools import partial
+
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Max, Min, Sum, When
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.dateformat import DateFormat
 from django.utils.translation import gettext_lazy as _
 
+from .caching import bump_version, get_version, get_versioned_value, get_versions, set_versioned_value
 from .custom import *
+from .receipt_images import forget_derivatives
+
+
+class ReferenceCounter(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    next_value = models.BigIntegerField(default=0)
+    key = models.CharField(max_length=64)
+    check_existing = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.name
+
+
+# How many requests an admission gate (see admission.py) has let through or turned away, across every process, and
+# how long the ones let through waited in total
+class AdmissionCounter(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    admitted = models.BigIntegerField(default=0)
+    rejected = models.BigIntegerField(default=0)
+    wait_ms = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
 
 
 class Currency(models.Model):
@@ -35,62 +63,123 @@ class User(AbstractUser):
     username = models.CharField(max_length=150,unique=False)
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username", "first_name", "last_name"]
-    back_url = models.CharField(max_length=60, default=None, blank=True, null=True)
 
     def __str__(self):
         return "{0} {1} ({2})".format(self.first_name, self.last_name, self.email)
 
     def count_claims_by_status(self, status):
-        return len(self.claims.filter(status=status))
+        return self.get_claim_counts()[status]
+
+    # Returns the number of the user's claims in each status, plus the total under "all". The counts come from one
+    # GROUP BY query and are cached until one of the user's claims is saved or deleted.
+    def get_claim_counts(self):
+        version, claim_counts = get_versioned_value("claim_counts", self.pk)
+        if claim_counts is None:
+            claim_counts = {status[0]: 0 for status in Claim.STATUSES}
+            for row in self.claims.order_by().values("status").annotate(count=Count("id")):
+                claim_counts[row["status"]] = row["count"]
+            claim_counts["all"] = sum(claim_counts.values())
+            set_versioned_value("claim_counts", self.pk, version, claim_counts, 60 * 60 * 24)
+        return claim_counts
+
+    # A change to who the user's manager or substitute is changes the roles of the managers and substitutes involved
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not {"primary_manager", "substitute"} & set(update_fields):
+            return super().save(*args, **kwargs)
+        old_ids = User.objects.filter(pk=self.pk).values_list("primary_manager_id", "substitute_id").first() \
+            if self.pk is not None else None
+        old_ids = list(old_ids or [None, None])
+        super().save(*args, **kwargs)
+        new_ids = [self.primary_manager_id, self.substitute_id]
+        if old_ids != new_ids:
+            manager_ids = {old_ids[0], new_ids[0]} - {None}
+            substitute_ids = User.objects.filter(pk__in=manager_ids).values_list("substitute_id", flat=True)
+            bump_role_versions([*old_ids, *new_ids, *substitute_ids])
+
+    def delete(self, *args, **kwargs):
+        substitute_ids = User.objects.filter(pk=self.primary_manager_id).values_list("substitute_id", flat=True)
+        affected_ids = [self.primary_manager_id, self.substitute_id, *substitute_ids]
+        result = super().delete(*args, **kwargs)
+        bump_role_versions(affected_ids)
+        return result
+
+    # Returns the user's role for the navigation bar: whether they're a manager (of a team, or as the substitute of
+    # another manager) and how many claims are waiting for them to review. It's worked out with two queries and cached
+    # until one of the team memberships, substitutes or claims it depends on changes. As every page shows it, the role
+    # and its version are read from the cache together.
+    def get_role(self):
+        if not hasattr(self, "_role"):
+            version, role = get_versioned_value("user_role", self.pk)
+            if role is None:
+                counts = User.objects.filter(models.Q(primary_manager=self) | models.Q(substitute=self)).aggregate(
+                    team_members=Count("pk", filter=models.Q(primary_manager=self)),
+                    substituted_managers=Count("pk", filter=models.Q(substitute=self)))
+                role = {"is_direct_manager": counts["team_members"] > 0,
+                        "is_manager": counts["team_members"] > 0 or counts["substituted_managers"] > 0}
+                role["pending_claims_count"] = self.get_all_teams_pending_claims().count() if role["is_manager"] else 0
+                set_versioned_value("user_role", self.pk, version, role, 60 * 60 * 24)
+            self._role = role
+        return self._role
 
     def is_manager(self):
-        if self.team_members.all() or self.other_managers.all():
-            return True
-        else:
-            return False
+        return self.get_role()["is_manager"]
 
     def is_direct_manager(self):
-        if self.team_members.all():
-            return True
-        else:
-            return False
+        return self.get_role()["is_direct_manager"]
 
     def get_your_teams_pending_claims(self):
-        your_teams_claims = None
-        for member in self.team_members.all():
-            if not your_teams_claims:
-                your_teams_claims = member.claims.filter(status="2")
-            else:
-                your_teams_claims.union(member.claims.filter(status="2"))
-        return your_teams_claims
+        return Claim.objects.pending_for_manager(self, scope="own")
 
     def get_other_teams_pending_claims(self):
-        other_teams_claims = None
-        for manager in self.other_managers.all():
-            for member in manager.team_members.all():
-                if not other_teams_claims:
-                    other_teams_claims = member.claims.filter(status="2")
-                else:
-                    other_teams_claims.union(member.claims.filter(status="2"))
-        return other_teams_claims
+        return Claim.objects.pending_for_manager(self, scope="substitute")
 
     def get_all_teams_pending_claims(self):
-        your_teams_claims = self.get_your_teams_pending_claims()
-        other_teams_claims = self.get_other_teams_pending_claims()
-        if your_teams_claims and other_teams_claims:
-            return your_teams_claims.union(other_teams_claims)
-        elif your_teams_claims:
-            return your_teams_claims
-        elif other_teams_claims:
-            return other_teams_claims
+        return Claim.objects.pending_for_manager(self, scope="all")
+
+
+# Invalidates the cached roles (see User.get_role) of the given users once the current transaction commits
+def bump_role_versions(user_ids):
+    for user_id in set(user_ids) - {None}:
+        transaction.on_commit(partial(bump_version, "user_role", user_id))
+
+
+# Invalidates the cached pending claims counts of the managers who review a user's claims
+def bump_reviewer_role_versions(owner_id):
+    reviewer_ids = User.objects.filter(pk=owner_id).values_list("primary_manager_id", "primary_manager__substitute_id")
+    for user_ids in reviewer_ids:
+        for user_id in set(user_ids) - {None}:
+            bump_version("user_role", user_id)
+
+
+class ClaimQuerySet(models.QuerySet):
+
+    # Pending claims that a manager can review, in a single query. The scope "own" covers the manager's team members,
+    # "substitute" covers the teams of managers who have chosen them as their substitute, and "all" covers both.
+    def pending_for_manager(self, manager, scope="all"):
+        if scope == "own":
+            condition = models.Q(owner__primary_manager=manager)
+        elif scope == "substitute":
+            condition = models.Q(owner__primary_manager__substitute=manager)
+        elif scope == "all":
+            condition = models.Q(owner__primary_manager=manager) | models.Q(owner__primary_manager__substitute=manager)
         else:
-            return None
+            raise ValueError("Unknown pending claims scope: {0}".format(scope))
+        return self.filter(condition, status="2")
+
+    # Claims along with what their details page shows (the owner, currency, approving manager, and the receipts in the
+    # order they were added with their categories), so the page takes the same few queries however many receipts the
+    # claim has. Each prefetched receipt's claim is set to the claim it was fetched with.
+    def with_details(self):
+        receipts = Receipt.objects.select_related("category").order_by("creation_datetime")
+        return self.select_related("owner", "currency", "approval_manager") \
+            .prefetch_related(models.Prefetch("receipts", queryset=receipts))
 
 
 class Claim(models.Model):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="claims", on_delete=models.CASCADE)
     currency = models.ForeignKey("Currency", on_delete=models.CASCADE)
-    reference = models.CharField(max_length=8)
+    reference = models.CharField(max_length=8, unique=True)
     creation_datetime = models.DateTimeField()
     submission_datetime = models.DateTimeField(default=None, blank=True, null=True)
     approval_datetime = models.DateTimeField(default=None, blank=True, null=True)
@@ -100,6 +189,29 @@ class Claim(models.Model):
     description = models.CharField(max_length=50)
     STATUSES = [("1", "Draft"), ("2", "Pending"), ("3", "Sent"), ("4", "Accepted"), ("5", "Rejected")]
     status = models.CharField(max_length=1, choices=STATUSES)
+    # Set when the claim is submitted if any of its receipt images look like another receipt's
+    possible_duplicates = models.BooleanField(default=False)
+    objects = ClaimQuerySet.as_manager()
+
+    # Summary of the claim's receipts, kept up to date by Receipt.save() and Receipt.delete() so that list pages
+    # don't need to query the receipts table
+    SUMMARY_FIELDS = ["receipts_count", "total_amount", "total_vat", "highest_vat_percent", "earliest_date_incurred",
+                      "latest_date_incurred"]
+    receipts_count = models.PositiveIntegerField(default=0)
+    total_amount = models.FloatField(default=0)
+    total_vat = models.FloatField(default=0)
+    highest_vat_percent = models.FloatField(default=None, blank=True, null=True)
+    earliest_date_incurred = models.DateField(default=None, blank=True, null=True)
+    latest_date_incurred = models.DateField(default=None, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Your expenses list, for all claims and for a single status, newest first
+            models.Index(fields=["owner", "status_update_datetime", "id"]),
+            models.Index(fields=["owner", "status", "status_update_datetime", "id"]),
+            # Manager's pending claims list, most recently submitted first
+            models.Index(fields=["status", "submission_datetime", "id"]),
+        ]
 
     @classmethod
     def create(cls, owner, currency, description):
@@ -110,6 +222,28 @@ class Claim(models.Model):
                     status=status, status_update_datetime=now)
         return claim
 
+    # Any change to a claim (including being created, submitted, approved or returned) invalidates the owner's cached
+    # claim counts once the change is committed
+    # Saving a claim that's already in the database leaves out the summary fields, as the receipts may have changed
+    # since it was loaded and only refresh_summary() writes them
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None and not kwargs.get("force_insert"):
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.SUMMARY_FIELDS]
+        super().save(*args, **kwargs)
+        transaction.on_commit(partial(bump_version, "claim_counts", self.owner_id))
+        transaction.on_commit(partial(bump_reviewer_role_versions, self.owner_id))
+        transaction.on_commit(partial(bump_version, "claim_row", self.pk))
+
+    def delete(self, *args, **kwargs):
+        owner_id = self.owner_id
+        claim_id = self.pk
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(partial(bump_version, "claim_counts", owner_id))
+        transaction.on_commit(partial(bump_reviewer_role_versions, owner_id))
+        transaction.on_commit(partial(bump_version, "claim_row", claim_id))
+        return result
+
     def submit(self):
         self.status = 2
         now = timezone.now()
@@ -137,32 +271,71 @@ class Claim(models.Model):
         else:
             return False
 
-    def user_can_view(self, user):
-        if self.owner == user:
-            return True
-        claims_user_can_view = user.get_all_teams_pending_claims()
-        if claims_user_can_view:
-            if self in claims_user_can_view:
-                return True
-        return False
+    # Whether the claim is pending and the user is one of the managers who can approve or return it
+    def user_can_review(self, user):
+        if self.status != "2":
+            return False
+        return user.get_all_teams_pending_claims().filter(pk=self.pk).exists()
 
     def get_receipts_list_sorted(self):
         return self.receipts.all().order_by("creation_datetime")
 
+    # Calculates the receipt summary fields from the receipts table in a single aggregate query
+    def calculate_summary(self):
+        vat_percent = Case(When(amount__gt=0, then=F("vat") * 100 / F("amount")), default=0.0,
+                           output_field=models.FloatField())
+        summary = self.receipts.aggregate(receipts_count=Count("id"), total_amount=Sum("amount"),
+                                          total_vat=Sum("vat"), highest_vat_percent=Max(vat_percent),
+                                          earliest_date_incurred=Min("date_incurred"),
+                                          latest_date_incurred=Max("date_incurred"))
+        summary["total_amount"] = summary["total_amount"] or 0
+        summary["total_vat"] = summary["total_vat"] or 0
+        return summary
+
+    def is_summary_current(self):
+        for field_name, value in self.calculate_summary().items():
+            if getattr(self, field_name) != value:
+                return False
+        return True
+
+    # Recalculates the receipt summary fields and writes them to the database without touching any other fields. The
+    # claim is locked first, so the receipts of another transaction that is changing them can't be missed.
+    def refresh_summary(self):
+        with transaction.atomic():
+            self.lock()
+            summary = self.calculate_summary()
+            for field_name, value in summary.items():
+                setattr(self, field_name, value)
+            Claim.objects.filter(pk=self.pk).update(**summary)
+        transaction.on_commit(partial(bump_version, "claim_row", self.pk))
+
+    # Locks the claim's row until the end of the current transaction, so that transactions changing its receipts run
+    # one after another. Lock the claim before writing its receipts, as adding one shares a lock on the claim that
+    # would otherwise deadlock with another transaction waiting for this one.
+    def lock(self):
+        list(Claim.objects.select_for_update().filter(pk=self.pk).values_list("pk", flat=True))
+
+    # The version of the claim's cached table rows (see the "fragments" cache), which changes whenever the claim is
+    # saved or its receipts change. Pages listing claims fetch them all at once with prefetch_row_versions().
+    def get_row_version(self):
+        if not hasattr(self, "_row_version"):
+            self._row_version = get_version("claim_row", self.pk)
+        return self._row_version
+
+    @classmethod
+    def prefetch_row_versions(cls, claims):
+        versions = get_versions("claim_row", [claim.pk for claim in claims])
+        for claim in claims:
+            claim._row_version = versions.get(claim.pk)
+
     def get_receipts_count(self):
-        return len(self.receipts.all())
+        return self.receipts_count
 
     def get_total_amount(self):
-        total = 0
-        for receipt in self.receipts.all():
-            total += receipt.amount
-        return total
+        return self.total_amount
 
     def get_total_vat(self):
-        total = 0
-        for receipt in self.receipts.all():
-            total += receipt.vat
-        return total
+        return self.total_vat
 
     def get_earliest_receipt(self):
         return self.receipts.all().earliest("date_incurred")
@@ -171,27 +344,10 @@ class Claim(models.Model):
         return self.receipts.all().latest("date_incurred")
 
     def get_highest_vat(self):
-        receipts = self.receipts.all()
-        if len(receipts) == 0:
-            return None
-        elif len(receipts) == 1:
-            receipt = receipts[0]
-            return receipt.vat / receipt.amount * 100
-        else:
-            highest_vat_percent = 0
-            for receipt in receipts:
-
-                try:
-                    receipt_vat = receipt.vat / receipt.amount * 100
-                except ZeroDivisionError:
-                    receipt_vat = 0
-
-                if receipt_vat > highest_vat_percent:
-                    highest_vat_percent = receipt_vat
-            return highest_vat_percent
+        return self.highest_vat_percent
 
     def get_latest_feedback(self):
-        return self.feedbacks.latest("creation_datetime")
+        return self.feedbacks.select_related("author").latest("creation_datetime")
 
     # Methods that return strings for display:
 
@@ -219,11 +375,10 @@ class Claim(models.Model):
         return "{0:d}%".format(int(self.get_highest_vat()))
 
     def get_string_dates_incurred(self):
-        try:
-            earliest_date = self.get_earliest_receipt().date_incurred
-        except AttributeError:
+        earliest_date = self.earliest_date_incurred
+        latest_date = self.latest_date_incurred
+        if not earliest_date:
             return None
-        latest_date = self.get_latest_receipt().date_incurred
         formatted_earliest_date = DateFormat(earliest_date)
         formatted_latest_date = DateFormat(latest_date)
         if earliest_date == latest_date:
@@ -251,25 +406,90 @@ class Category(models.Model):
         return self.name
 
 
+# Currencies and categories are held in memory by every process (see reference_data.py), so any change to them makes
+# this process read them again once it's committed, and the others when they next check the version
+@receiver([post_save, post_delete], sender=Currency)
+@receiver([post_save, post_delete], sender=Category)
+def reference_data_changed(sender, **kwargs):
+    from .reference_data import reference_tables
+    transaction.on_commit(partial(bump_version, "reference_data", sender._meta.model_name))
+    transaction.on_commit(reference_tables[sender].expire)
+
+
+# Deleting a receipt's image (which django-cleanup does when the receipt is deleted or its image is replaced) only
+# deletes the stored file once no other receipt uses it
+class ReceiptImageFieldFile(models.fields.files.ImageFieldFile):
+    def delete(self, save=True):
+        if not self:
+            return
+        if hasattr(self, "_file"):
+            self.close()
+            del self.file
+        ReceiptImageBlob.release(self.name)
+        self.name = None
+        setattr(self.instance, self.field.attname, self.name)
+        self._committed = False
+        if save:
+            self.instance.save()
+
+    delete.alters_data = True
+
+
+class ReceiptImageField(models.ImageField):
+    attr_class = ReceiptImageFieldFile
+
+
 class Receipt(models.Model):
     claim = models.ForeignKey("Claim", related_name="receipts", on_delete=models.CASCADE)
-    reference = models.CharField(max_length=10)
+    reference = models.CharField(max_length=10, unique=True)
     creation_datetime = models.DateTimeField()
     date_incurred = models.DateField()
     category = models.ForeignKey("Category", on_delete=models.CASCADE)
     amount = models.FloatField()
     vat = models.FloatField()
     description = models.TextField(max_length=200)
-    file = models.ImageField(default=None, blank=True, null=True)
+    file = ReceiptImageField(default=None, blank=True, null=True)
+    IMAGE_STATUSES = [("1", "Processing"), ("2", "Ready"), ("3", "Failed")]
+    image_status = models.CharField(max_length=1, choices=IMAGE_STATUSES, default=None, blank=True, null=True)
+    # A 64-bit difference hash of the image, in hex, for finding photos of the same receipt (see duplicates.py)
+    image_hash = models.CharField(max_length=16, default=None, blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["claim", "creation_datetime"])]
 
     @classmethod
-    def create(cls, claim, category, date_incurred, amount, vat, description):
+    def create(cls, claim, category, date_incurred, amount, vat, description, reference=None):
         now = timezone.now()
-        reference = get_unique_reference(cls, "R")
+        if reference is None:
+            reference = get_unique_reference(cls, "R")
         receipt = cls(reference=reference, creation_datetime=now, claim=claim, category=category,
                       date_incurred=date_incurred, amount=amount, vat=vat, description=description)
         return receipt
 
+    # Saving or deleting a receipt also refreshes its claim's summary fields, within the same transaction
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not set(update_fields) & {"claim", "date_incurred", "amount", "vat"}:
+            super().save(*args, **kwargs)
+            return
+        with transaction.atomic():
+            claim = self.get_claim_for_update()
+            super().save(*args, **kwargs)
+            claim.refresh_summary()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            claim = self.get_claim_for_update()
+            result = super().delete(*args, **kwargs)
+            claim.refresh_summary()
+        return result
+
+    # Locks the parent claim (see Claim.lock) and returns it, without fetching it unless it has already been loaded
+    def get_claim_for_update(self):
+        claim = self.claim if Receipt.claim.is_cached(self) else Claim(pk=self.claim_id)
+        claim.lock()
+        return claim
+
     # Methods that return strings for display:
 
     def __str__(self):
@@ -285,6 +505,121 @@ class Receipt(models.Model):
         return "{0:d}%".format(int(round(100 * self.vat / self.amount)))
 
 
+# A stored receipt image, shared by every receipt whose upload had the same content hash
+class ReceiptImageBlob(models.Model):
+    content_hash = models.CharField(max_length=64, unique=True)
+    file_name = models.CharField(max_length=255, unique=True)
+    image_hash = models.CharField(max_length=16, default=None, blank=True, null=True)
+    reference_count = models.PositiveIntegerField(default=1)
+    creation_datetime = models.DateTimeField()
+
+    @classmethod
+    def create(cls, content_hash, file_name, image_hash):
+        now = timezone.now()
+        blob = cls(content_hash=content_hash, file_name=file_name, image_hash=image_hash, creation_datetime=now)
+        return blob
+
+    # Adds a reference to the image stored for an upload, returning its blob, or None if it hasn't been stored yet
+    @classmethod
+    def acquire(cls, content_hash):
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(content_hash=content_hash).first()
+            if blob is None:
+                return None
+            cls.objects.filter(pk=blob.pk).update(reference_count=F("reference_count") + 1)
+            return blob
+
+    # Records a newly stored image with one reference, returning its blob. If the same upload was stored at the same
+    # time by another request, its image is used instead and this copy is deleted.
+    @classmethod
+    def register(cls, content_hash, file_name, image_hash):
+        try:
+            with transaction.atomic():
+                blob = cls.create(content_hash, file_name, image_hash)
+                blob.save()
+            return blob
+        except IntegrityError:
+            existing_blob = cls.acquire(content_hash)
+            if existing_blob is None:
+                raise
+            if existing_blob.file_name != file_name:
+                FileDeletion.enqueue([file_name] + forget_derivatives(file_name))
+            return existing_blob
+
+    # Removes a reference, queueing the stored image (and its smaller sizes) to be deleted when it was the last one.
+    # Images stored before deduplication have no blob and only ever have one receipt.
+    @classmethod
+    def release(cls, file_name):
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(file_name=file_name).first()
+            if blob is not None and blob.reference_count > 1:
+                cls.objects.filter(pk=blob.pk).update(reference_count=F("reference_count") - 1)
+                return
+            if blob is not None:
+                blob.delete()
+            FileDeletion.enqueue([file_name] + forget_derivatives(file_name))
+
+    def __str__(self):
+        return self.file_name
+
+
+# Stored files waiting to be deleted. They're deleted in batches by the image worker pool once the transaction that
+# queued them commits, or by the deletions process in the Procfile ('manage.py process_file_deletions --loop'), which
+# retries failed deletions when they're due. That way deleting a claim doesn't wait on storage.
+class FileDeletion(models.Model):
+    file_name = models.CharField(max_length=255)
+    creation_datetime = models.DateTimeField()
+    run_after_datetime = models.DateTimeField()
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["run_after_datetime"]), models.Index(fields=["file_name"])]
+
+    @classmethod
+    def create(cls, file_name):
+        now = timezone.now()
+        deletion = cls(file_name=file_name, creation_datetime=now, run_after_datetime=now)
+        return deletion
+
+    @classmethod
+    def enqueue(cls, file_names):
+        from .jobs import start_file_deletions
+        cls.objects.bulk_create([cls.create(file_name) for file_name in file_names])
+        transaction.on_commit(start_file_deletions)
+
+    def __str__(self):
+        return "deletion of {0}".format(self.file_name)
+
+
+# An uploaded receipt image waiting to be resized and stored by a background worker (see jobs.py)
+class ReceiptImageJob(models.Model):
+    receipt = models.ForeignKey("Receipt", related_name="image_jobs", on_delete=models.CASCADE)
+    # The upload's name in the media storage, where every worker can read it
+    spool_path = models.CharField(max_length=255)
+    file_name = models.CharField(max_length=255)
+    creation_datetime = models.DateTimeField()
+    run_after_datetime = models.DateTimeField()
+    locked_until_datetime = models.DateTimeField(default=None, blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    STATUSES = [("1", "Queued"), ("2", "Running"), ("3", "Done"), ("4", "Failed")]
+    status = models.CharField(max_length=1, choices=STATUSES)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after_datetime"])]
+
+    @classmethod
+    def create(cls, receipt, spool_path, file_name):
+        now = timezone.now()
+        job = cls(receipt=receipt, spool_path=spool_path, file_name=file_name, creation_datetime=now,
+                  run_after_datetime=now, status="1")
+        return job
+
+    def __str__(self):
+        return "image job for {0}".format(self.receipt)
+
+
 class Feedback(models.Model):
     claim = models.ForeignKey("Claim", related_name="feedbacks", on_delete=models.CASCADE)
     creation_datetime = models.DateTimeField()
@@ -292,6 +627,9 @@ class Feedback(models.Model):
     comment = models.CharField(max_length=300)
     action_desc = models.CharField(max_length=100)
 
+    class Meta:
+        indexes = [models.Index(fields=["claim", "creation_datetime"])]
+
     @classmethod
     def create(cls, creation_datetime, claim, author, comment, action_desc):
         feedback = cls(claim=claim, creation_datetime=creation_datetime, author=author, comment=comment,
@@ -0,0 +1,132 @@
+import math
+
+from django.core import signing
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+# Paginates a queryset by seeking on the values of its ordering fields (e.g. a timestamp followed by the id as a
+# tie-breaker), rather than by OFFSET, so that every page costs the same to fetch no matter how deep it is.
+# Links between pages carry a signed cursor holding the key of the first or last row of the current page.
+class KeysetPaginator:
+    cursor_salt = "expensesapp.pagination"
+
+    def __init__(self, queryset, ordering, per_page, count=None):
+        self.queryset = queryset
+        self.ordering = ordering
+        self.per_page = per_page
+        if count is not None:
+            self.count = count
+
+    @cached_property
+    def count(self):
+        return self.queryset.count()
+
+    @cached_property
+    def num_pages(self):
+        return max(1, math.ceil(self.count / self.per_page))
+
+    def get_page(self, number, cursor=None):
+        position = self.decode_cursor(cursor)
+        if number == 1:
+            object_list = list(self.queryset.order_by(*self.ordering)[:self.per_page])
+        elif number == self.num_pages:
+            last_page_size = self.count - (self.num_pages - 1) * self.per_page
+            object_list = list(self.queryset.order_by(*self.reversed_ordering())[:last_page_size])[::-1]
+        elif position:
+            key, direction, skip = position
+            if direction == "next":
+                seek_queryset = self.queryset.filter(self.seek_condition(key)).order_by(*self.ordering)
+                object_list = list(seek_queryset[skip:skip + self.per_page])
+            else:
+                seek_queryset = self.queryset.filter(self.seek_condition(key, backwards=True))
+                seek_queryset = seek_queryset.order_by(*self.reversed_ordering())
+                object_list = list(seek_queryset[skip:skip + self.per_page])[::-1]
+        else:
+            # Pages that weren't reached through a link (e.g. typed in) fall back to an OFFSET query
+            offset = (number - 1) * self.per_page
+            object_list = list(self.queryset.order_by(*self.ordering)[offset:offset + self.per_page])
+        return KeysetPage(self, number, object_list, cursor)
+
+    def get_key(self, obj):
+        return [getattr(obj, field.lstrip("-")) for field in self.ordering]
+
+    def reversed_ordering(self):
+        return [field[1:] if field.startswith("-") else "-" + field for field in self.ordering]
+
+    # Builds the condition for the rows that come after the key in the ordering (or before it, going backwards)
+    def seek_condition(self, key, backwards=False):
+        condition = Q()
+        equal_fields = {}
+        for field, value in zip(self.ordering, key):
+            field_name = field.lstrip("-")
+            descending = field.startswith("-")
+            lookup = "lt" if descending != backwards else "gt"
+            condition |= Q(**equal_fields, **{"{0}__{1}".format(field_name, lookup): value})
+            equal_fields[field_name] = value
+        return condition
+
+    # Datetimes in the key are stored as ISO 8601 strings, which Django converts back when building the query
+    def encode_cursor(self, obj, direction, skip):
+        key = [value.isoformat() if hasattr(value, "isoformat") else value for value in self.get_key(obj)]
+        return signing.dumps([key, direction, skip], salt=self.cursor_salt)
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            key, direction, skip = signing.loads(cursor, salt=self.cursor_salt)
+        except (signing.BadSignature, ValueError, TypeError):
+            return None
+        if direction not in ("next", "previous") or not isinstance(skip, int) or skip < 0:
+            return None
+        return key, direction, skip
+
+
+class KeysetPage:
+
+    def __init__(self, paginator, number, object_list, cursor):
+        self.paginator = paginator
+        self.number = number
+        self.object_list = object_list
+        self.cursor = cursor
+
+    # Returns the page number and the cursor needed to reach it from this page
+    def get_link(self, number):
+        if number == self.number:
+            cursor = self.cursor
+        elif number == 1 or number == self.paginator.num_pages:
+            cursor = None
+        elif number > self.number:
+            skip = (number - self.number - 1) * self.paginator.per_page
+            cursor = self.paginator.encode_cursor(self.object_list[-1], "next", skip)
+        else:
+            skip = (self.number - number - 1) * self.paginator.per_page
+            cursor = self.paginator.encode_cursor(self.object_list[0], "previous", skip)
+        return {"number": number, "cursor": cursor}
+
+    # Returns the links shown in the pagination bar: up to two pages either side of this one, plus the newest and
+    # oldest pages when they are further away
+    def get_navigation(self):
+        num_pages = self.paginator.num_pages
+        clickable_pages = []
+        newest_page = False
+        oldest_page = False
+        previous_page = False
+        next_page = False
+        if self.object_list:
+            for page in range(max(1, self.number - 2), min(num_pages, self.number + 2) + 1):
+                clickable_pages.append(self.get_link(page))
+                if page == self.number - 1:
+                    previous_page = clickable_pages[-1]
+                elif page == self.number + 1:
+                    next_page = clickable_pages[-1]
+            if self.number - 2 > 1:
+                newest_page = self.get_link(1)
+            if self.number + 2 < num_pages:
+                oldest_page = self.get_link(num_pages)
+        if len(clickable_pages) <= 1:
+            clickable_pages = None
+        return {"current_page": self.number, "clickable_pages": clickable_pages, "newest_page": newest_page,
+                "oldest_page": oldest_page, "previous_page": previous_page, "next_page": next_page}
+
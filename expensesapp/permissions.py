@@ -0,0 +1,89 @@
+from functools import wraps
+
+from django.http import Http404
+from django.shortcuts import render
+
+from expensesapp.models import Claim, Receipt
+
+
+# Answers what a user can do with claims, remembering the answers for the rest of the request (see
+# get_claim_permissions). Owners can view their claims and edit them while they're editable. Managers can view and
+# review (approve or return) the pending claims of their team and of the teams they're a substitute for, which takes
+# one EXISTS query for each claim.
+class ClaimPermissions:
+    def __init__(self, user):
+        self.user = user
+        self.reviewable = {}
+
+    def can_view(self, claim):
+        return claim.owner_id == self.user.pk or self.can_review(claim)
+
+    def can_edit(self, claim):
+        return claim.owner_id == self.user.pk and claim.is_editable()
+
+    def can_review(self, claim):
+        if claim.pk not in self.reviewable:
+            self.reviewable[claim.pk] = claim.user_can_review(self.user)
+        return self.reviewable[claim.pk]
+
+    def has_permission(self, claim, permission):
+        if permission == "view":
+            return self.can_view(claim)
+        elif permission == "edit":
+            return self.can_edit(claim)
+        elif permission == "review":
+            return self.can_review(claim)
+        raise ValueError("Unknown claim permission: {0}".format(permission))
+
+
+def get_claim_permissions(request):
+    if not hasattr(request, "claim_permissions"):
+        request.claim_permissions = ClaimPermissions(request.user)
+    return request.claim_permissions
+
+
+def access_denied(request):
+    return render(request, "expensesapp/access_denied.html")
+
+
+def not_found(request):
+    raise Http404
+
+
+# Makes a view that takes a claim_ref argument take the claim itself instead, after checking that it exists and that
+# the user has the given permission for it ("view", "edit" or "review"). Otherwise the view isn't called, and the
+# denied function's response (the access denied page, by default) is returned instead.
+def claim_permission_required(permission, queryset=Claim.objects.all(), denied=access_denied):
+    def decorator(view):
+        @wraps(view)
+        def wrapped_view(request, claim_ref, *args, **kwargs):
+            try:
+                claim = queryset.get(reference=claim_ref)
+            except Claim.DoesNotExist:
+                return denied(request)
+            if not get_claim_permissions(request).has_permission(claim, permission):
+                return denied(request)
+            return view(request, claim, *args, **kwargs)
+
+        return wrapped_view
+
+    return decorator
+
+
+# The same as claim_permission_required, for views that take a receipt_ref argument, with the permission checked for
+# the receipt's claim
+def receipt_permission_required(permission, queryset=Receipt.objects.select_related("claim"), denied=access_denied):
+    def decorator(view):
+        @wraps(view)
+        def wrapped_view(request, receipt_ref, *args, **kwargs):
+            try:
+                receipt = queryset.get(reference=receipt_ref)
+            except Receipt.DoesNotExist:
+                return denied(request)
+            if not get_claim_permissions(request).has_permission(receipt.claim, permission):
+                return denied(request)
+            return view(request, receipt, *args, **kwargs)
+
+        return wrapped_view
+
+    return decorator
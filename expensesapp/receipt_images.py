@@ -0,0 +1,160 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.urls import reverse
+from PIL import Image, features
+
+# Smaller copies of each receipt image, stored next to the original and named after it (e.g. R123_photo.preview.jpeg).
+# The "full" size is the stored image itself.
+RECEIPT_IMAGE_SIZES = {"thumbnail": (160, 160), "preview": (800, 800)}
+
+# The formats receipt images can be stored in: the name Pillow uses, the file extension, and the Pillow feature the
+# format depends on (JPEG is always available, so it's used whenever the chosen format isn't)
+RECEIPT_IMAGE_FORMATS = {
+    "jpeg": ("JPEG", ".jpeg", None),
+    "webp": ("WEBP", ".webp", "webp"),
+    "avif": ("AVIF", ".avif", "avif"),
+}
+
+# "greyscale" and "bilevel" (black and white only) suit receipts that are mostly text, and compress much better
+RECEIPT_IMAGE_COLOUR_MODES = ["colour", "greyscale", "bilevel"]
+
+
+def get_image_format(image_format):
+    pillow_format, extension, feature = RECEIPT_IMAGE_FORMATS.get(image_format, RECEIPT_IMAGE_FORMATS["jpeg"])
+    if feature and not features.check(feature):
+        return get_image_format("jpeg")
+    return pillow_format, extension
+
+
+# Returns the format key for a stored file, from its extension
+def get_image_format_for_name(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    for image_format, (pillow_format, format_extension, feature) in RECEIPT_IMAGE_FORMATS.items():
+        if extension == format_extension:
+            return image_format
+    return "jpeg"
+
+
+# Encodes a decoded receipt image using the RECEIPT_IMAGE_* settings, unless told otherwise. Returns the encoded file
+# and the extension to store it with.
+def encode_receipt_image(image, image_format=None, quality=None, colour_mode=None, progressive=None):
+    pillow_format, extension = get_image_format(image_format or settings.RECEIPT_IMAGE_FORMAT)
+    quality = quality or settings.RECEIPT_IMAGE_QUALITY
+    colour_mode = colour_mode or settings.RECEIPT_IMAGE_COLOUR_MODE
+    if progressive is None:
+        progressive = settings.RECEIPT_IMAGE_PROGRESSIVE
+
+    if colour_mode == "greyscale":
+        image = image.convert("L")
+    elif colour_mode == "bilevel":
+        # None of the formats store 1-bit images, but two-tone greyscale still compresses far better than a photo
+        image = image.convert("L").convert("1", dither=Image.Dither.NONE).convert("L")
+
+    blob = BytesIO()
+    if pillow_format == "JPEG":
+        image.save(blob, pillow_format, quality=quality, optimize=True, progressive=progressive)
+    elif pillow_format == "WEBP":
+        image.save(blob, pillow_format, quality=quality, method=6)
+    else:
+        image.save(blob, pillow_format, quality=quality)
+    return blob, extension
+
+
+def get_derivative_name(file_name, size):
+    base_name, extension = os.path.splitext(file_name)
+    return "{0}.{1}{2}".format(base_name, size, extension)
+
+
+# Remembers which derivatives are known to exist, so that pages don't have to ask the storage backend
+def get_derivative_cache_key(file_name, size):
+    return "receipt_image_derivative:{0}:{1}".format(size, file_name)
+
+
+# Saves every derivative of a receipt image, from an image that has already been decoded
+def save_derivatives(storage, file_name, image):
+    for size in RECEIPT_IMAGE_SIZES:
+        save_derivative(storage, file_name, image, size)
+
+
+def save_derivative(storage, file_name, image, size):
+    derivative = image.copy()
+    derivative.thumbnail(RECEIPT_IMAGE_SIZES[size], Image.Resampling.LANCZOS)
+    # Derivatives are stored in the same format as the original, as their names share its extension
+    blob, extension = encode_receipt_image(derivative, image_format=get_image_format_for_name(file_name),
+                                           quality=settings.RECEIPT_IMAGE_DERIVATIVE_QUALITY)
+    derivative_name = get_derivative_name(file_name, size)
+    # Derivatives are only saved when they don't exist yet. If another process saved the same one meanwhile, storage
+    # backends that don't overwrite files will have given this copy another name, so it's removed again.
+    saved_name = storage.save(derivative_name, File(blob))
+    if saved_name != derivative_name:
+        storage.delete(saved_name)
+    cache.set(get_derivative_cache_key(file_name, size), True, None)
+
+
+def is_derivative_cached(file_name, size):
+    return cache.get(get_derivative_cache_key(file_name, size), False)
+
+
+# Storage backends other than this app's sign one URL at a time
+def get_file_urls(storage, names):
+    if not names:
+        return []
+    if hasattr(storage, "get_urls"):
+        return storage.get_urls(names)
+    return [storage.url(name) for name in names]
+
+
+# Returns the URLs of several receipts' images at the given size ("thumbnail", "preview" or "full"), with one cache
+# lookup for which sizes have been generated and one for the signed URLs, however many receipts there are. Sizes that
+# haven't been generated yet point at receipt_image_view, which creates them on first request.
+def get_receipt_image_urls(receipts, size="full"):
+    storage = receipts[0].file.storage if receipts else None
+    if size not in RECEIPT_IMAGE_SIZES:
+        return get_file_urls(storage, [receipt.file.name for receipt in receipts])
+    cache_keys = [get_derivative_cache_key(receipt.file.name, size) for receipt in receipts]
+    cached_keys = cache.get_many(cache_keys)
+    derivative_names = [get_derivative_name(receipt.file.name, size)
+                        for receipt, cache_key in zip(receipts, cache_keys) if cache_key in cached_keys]
+    derivative_urls = iter(get_file_urls(storage, derivative_names))
+    return [next(derivative_urls) if cache_key in cached_keys
+            else reverse("expensesapp:receipt_image", args=[receipt.reference, size])
+            for receipt, cache_key in zip(receipts, cache_keys)]
+
+
+# Returns the name of a derivative of a receipt's image, generating it from the original if it doesn't exist yet
+# (e.g. for images that were uploaded before derivatives were introduced)
+def get_or_create_derivative(receipt_file, size):
+    if size not in RECEIPT_IMAGE_SIZES:
+        return receipt_file.name
+    derivative_name = get_derivative_name(receipt_file.name, size)
+    if not is_derivative_cached(receipt_file.name, size):
+        if receipt_file.storage.exists(derivative_name):
+            cache.set(get_derivative_cache_key(receipt_file.name, size), True, None)
+        else:
+            with receipt_file.storage.open(receipt_file.name) as original_file:
+                image = Image.open(original_file)
+                image.draft("RGB", RECEIPT_IMAGE_SIZES[size])
+                save_derivative(receipt_file.storage, receipt_file.name, image, size)
+    return derivative_name
+
+
+# Returns a difference hash of an image as 16 hex digits: one bit for each pair of horizontally adjacent pixels in a
+# 9x8 greyscale thumbnail, set if the left one is brighter. It survives rescaling, recompression and small changes in
+# lighting, so two photos of the same receipt give hashes that differ by only a few bits.
+def get_image_hash(image):
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.BOX).getdata())
+    image_hash = 0
+    for row in range(8):
+        for column in range(8):
+            image_hash = image_hash << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return "{0:016x}".format(image_hash)
+
+
+# Returns the names of the smaller sizes of a receipt image that is being deleted, after forgetting that they exist
+def forget_derivatives(file_name):
+    cache.delete_many([get_derivative_cache_key(file_name, size) for size in RECEIPT_IMAGE_SIZES])
+    return [get_derivative_name(file_name, size) for size in RECEIPT_IMAGE_SIZES]
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from expensesapp.caching import get_version
+from expensesapp.models import Category, Currency
+
+
+# A small lookup table (such as the currencies), held in memory by each process in name order along with its form
+# choices, as it hardly ever changes. Saving or deleting a row bumps the table's "reference_data" version (see
+# reference_data_changed), which makes every process read it again the next time it checks the version.
+class ReferenceTable:
+    # Seconds between checks of the version, so that most uses of a table don't need a cache lookup. Changes made by
+    # other processes show up within this time, and changes made by this process straight away (see expire()).
+    check_interval = 5
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = None
+        self.rows = []
+        self.rows_by_name = {}
+        self.choices = []
+        self.labelled_choices = []
+
+    def sync(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.checked_at is not None and now - self.checked_at < self.check_interval:
+                return self
+            self.checked_at = now
+        version = get_version("reference_data", self.model._meta.model_name)
+        with self.lock:
+            if version != self.version:
+                rows = list(self.model.objects.order_by("name"))
+                self.rows_by_name = {row.name: row for row in rows}
+                self.choices = [(row.name, row.name) for row in rows]
+                self.labelled_choices = [(row.name, str(row)) for row in rows]
+                self.rows = rows
+                self.version = version
+        return self
+
+    def expire(self):
+        with self.lock:
+            self.checked_at = None
+
+    def all(self):
+        return self.sync().rows
+
+    # Raises the model's DoesNotExist, as objects.get() would
+    def get(self, name):
+        try:
+            return self.sync().rows_by_name[name]
+        except KeyError:
+            raise self.model.DoesNotExist("{0} matching name {1!r} does not exist.".format(
+                self.model.__name__, name))
+
+    def get_choices(self):
+        return self.sync().choices
+
+    # Choices labelled with str(row) rather than the name, with the given row (if any) first
+    def get_labelled_choices(self, first=None):
+        choices = self.sync().labelled_choices
+        if first is None or first.name not in self.rows_by_name:
+            return choices
+        return [choice for choice in choices if choice[0] == first.name] + \
+            [choice for choice in choices if choice[0] != first.name]
+
+
+currency_table = ReferenceTable(Currency)
+category_table = ReferenceTable(Category)
+reference_tables = {Currency: currency_table, Category: category_table}
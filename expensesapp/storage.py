@@ -0,0 +1,289 @@
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import urlencode
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+logger = logging.getLogger(__name__)
+
+# Time spent on each kind of storage operation in this process, as {operation: [count, total seconds, max seconds]}
+storage_timings = {}
+storage_timings_lock = threading.Lock()
+
+
+@contextmanager
+def time_storage_operation(operation):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_time = time.perf_counter() - start_time
+        logger.debug("Storage %s took %.1f ms", operation, elapsed_time * 1000)
+        with storage_timings_lock:
+            timing = storage_timings.setdefault(operation, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed_time
+            timing[2] = max(timing[2], elapsed_time)
+
+
+def timed(operation):
+    def decorator(method):
+        @wraps(method)
+        def wrapped_method(*args, **kwargs):
+            with time_storage_operation(operation):
+                return method(*args, **kwargs)
+
+        return wrapped_method
+
+    return decorator
+
+
+def get_storage_timings():
+    with storage_timings_lock:
+        return {operation: {"count": count, "average_ms": total / count * 1000, "max_ms": maximum * 1000}
+                for operation, (count, total, maximum) in storage_timings.items()}
+
+
+def reset_storage_timings():
+    with storage_timings_lock:
+        storage_timings.clear()
+
+
+shared_connections = {}
+shared_connections_lock = threading.Lock()
+
+
+# Returns the S3 client for a storage's connection settings, and the resource class to wrap it in, creating them the
+# first time. Clients are thread-safe, so every thread in the process shares one client and its pool of connections,
+# where S3Boto3Storage would create a session, client and pool for each thread.
+def get_shared_connection(storage):
+    key = (storage.access_key, storage.secret_key, storage.security_token, storage.session_profile,
+           storage.region_name, storage.endpoint_url, storage.use_ssl, storage.verify,
+           storage.client_config.max_pool_connections)
+    with shared_connections_lock:
+        if key not in shared_connections:
+            resource = storage._create_session().resource(
+                "s3", region_name=storage.region_name, use_ssl=storage.use_ssl, endpoint_url=storage.endpoint_url,
+                config=storage.client_config, verify=storage.verify)
+            shared_connections[key] = (resource.meta.client, type(resource))
+        return shared_connections[key]
+
+
+# Media storage on S3 with a shared connection pool (see get_shared_connection). Objects smaller than the multipart
+# threshold are stored with a single PutObject request, and larger ones are streamed in parts, several at once. The
+# time taken by each operation is logged and kept for get_storage_timings(). Signed URLs are cached (see url()).
+class ReceiptStorage(S3Boto3Storage):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.client_config = self.client_config.merge(Config(
+            max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS, tcp_keepalive=True,
+            retries={"mode": "standard"}))
+        if getattr(settings, "AWS_S3_TRANSFER_CONFIG", None) is None:
+            self.transfer_config = TransferConfig(
+                multipart_threshold=settings.AWS_S3_MULTIPART_THRESHOLD,
+                multipart_chunksize=settings.AWS_S3_MULTIPART_CHUNKSIZE,
+                max_concurrency=settings.AWS_S3_MULTIPART_CONCURRENCY)
+
+    @property
+    def connection(self):
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            # Resources aren't thread-safe, but they're only light wrappers around the shared client
+            client, resource_class = get_shared_connection(self)
+            connection = self._connections.connection = resource_class(client=client)
+        return connection
+
+    @timed("save")
+    def _save(self, name, content):
+        size = getattr(content, "size", None)
+        if size is None or size >= self.transfer_config.multipart_threshold or self.gzip:
+            return super()._save(name, content)
+        # Uploading through the transfer manager starts a pool of threads for each file, which costs more than
+        # sending a small image
+        cleaned_name = clean_name(name)
+        key = self._normalize_name(cleaned_name)
+        content.seek(0)
+        self.connection.meta.client.put_object(Bucket=self.bucket_name, Key=key, Body=content.read(),
+                                               **self._get_write_parameters(key, content))
+        return cleaned_name
+
+    @timed("open")
+    def _open(self, name, mode="rb"):
+        return super()._open(name, mode)
+
+    @timed("delete")
+    def delete(self, name):
+        return super().delete(name)
+
+    @timed("exists")
+    def exists(self, name):
+        return super().exists(name)
+
+    @timed("size")
+    def size(self, name):
+        return super().size(name)
+
+    # Stored files never change, so browsers can keep them for as long as their URLs stay the same
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        params.setdefault("CacheControl", "private, max-age={0}".format(self.querystring_expire))
+        return params
+
+    # Signed URLs are shared through the cache for the rest of the period they were signed in. Periods are half as long
+    # as URLs last, so a cached URL always has at least half of its time left, and pages showing the same image use
+    # the same URL for a while, which browsers can cache.
+    @timed("url")
+    def url(self, name, parameters=None, expire=None, http_method=None):
+        if parameters or expire is not None or http_method:
+            return super().url(name, parameters, expire, http_method)
+        return self.get_urls([name])[0]
+
+    # Returns the URLs of several files, looking them all up in the cache at once
+    def get_urls(self, names):
+        if not self.querystring_auth or self.custom_domain:
+            return [super(ReceiptStorage, self).url(name) for name in names]
+        period = max(self.querystring_expire // 2, 1)
+        now = time.time()
+        period_num = int(now // period)
+        keys = ["signed_url:{0}:{1}:{2}".format(self.bucket_name, period_num, name) for name in names]
+        urls = cache.get_many(keys)
+        new_urls = {key: super(ReceiptStorage, self).url(name) for name, key in zip(names, keys) if key not in urls}
+        if new_urls:
+            cache.set_many(new_urls, timeout=max(int((period_num + 1) * period - now), 1))
+            urls.update(new_urls)
+        return [urls[key] for key in keys]
+
+
+# Media storage on the local disk, for development and single-server deployments. Files are written to a temporary
+# file and synced before they're given their name, so a crash never leaves a partly written image behind, and reads
+# are memory-mapped. URLs are signed like S3's and point at media_view, which checks them before serving the file.
+class LocalReceiptStorage(FileSystemStorage):
+    def __init__(self, url_expire=3600, **kwargs):
+        super().__init__(**kwargs)
+        self.url_expire = url_expire
+
+    @timed("save")
+    def _save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                for chunk in content.chunks():
+                    temp_file.write(chunk)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            while True:
+                try:
+                    # Unlike renaming, linking fails if another file was saved under the name in the meantime
+                    link_or_copy(temp_path, full_path)
+                    break
+                except FileExistsError:
+                    name = self.get_available_name(name)
+                    full_path = self.path(name)
+        finally:
+            os.remove(temp_path)
+        fsync_directory(directory)
+        return str(name).replace("\\", "/")
+
+    @timed("open")
+    def _open(self, name, mode="rb"):
+        if mode != "rb":
+            return super()._open(name, mode)
+        with open(self.path(name), "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            # Empty files can't be mapped
+            if size == 0:
+                return super()._open(name, mode)
+            mapped_file = MappedFile(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), name)
+        mapped_file.size = size
+        return mapped_file
+
+    @timed("delete")
+    def delete(self, name):
+        return super().delete(name)
+
+    @timed("exists")
+    def exists(self, name):
+        return super().exists(name)
+
+    # URLs stay the same for half of url_expire, and then last for at least the other half (as in ReceiptStorage)
+    def url(self, name):
+        period = max(self.url_expire // 2, 1)
+        expires = (int(time.time()) // period + 2) * period
+        return "{0}?{1}".format(reverse("expensesapp:media", args=[name.replace("\\", "/")]),
+                                urlencode({"expires": expires, "signature": self.get_signature(name, expires)}))
+
+    def get_urls(self, names):
+        return [self.url(name) for name in names]
+
+    def get_signature(self, name, expires):
+        return salted_hmac("expensesapp.storage.LocalReceiptStorage", "{0}:{1}".format(name, expires)).hexdigest()
+
+    def is_valid_signature(self, name, expires, signature):
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        return expires > time.time() and constant_time_compare(signature or "", self.get_signature(name, expires))
+
+
+# A memory-mapped file. File.closed would check the map's length, which can't be done once it's closed.
+class MappedFile(File):
+    @property
+    def closed(self):
+        return self.file.closed
+
+
+# Gives a file a second name, copying it on filesystems that don't support hard links (e.g. FAT, and some network
+# mounts). The copy is only created if nothing has the name yet, like a link, but it's visible before it's complete,
+# so it's removed again if writing it fails.
+def link_or_copy(source_path, destination_path):
+    try:
+        os.link(source_path, destination_path)
+        return
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    destination_descriptor = os.open(destination_path, flags, 0o666)
+    try:
+        with os.fdopen(destination_descriptor, "wb") as destination_file, open(source_path, "rb") as source_file:
+            shutil.copyfileobj(source_file, destination_file)
+            destination_file.flush()
+            os.fsync(destination_file.fileno())
+    except BaseException:
+        os.remove(destination_path)
+        raise
+    shutil.copymode(source_path, destination_path)
+
+
+def fsync_directory(directory):
+    # Windows can't open directories, and doesn't need them syncing to keep a new file's name
+    if os.name == "nt":
+        return
+    directory_descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_descriptor)
+    finally:
+        os.close(directory_descriptor)
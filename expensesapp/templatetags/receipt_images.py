@@ -0,0 +1,16 @@
+from django import template
+
+from expensesapp.receipt_images import get_receipt_image_urls
+
+register = template.Library()
+
+
+# Returns the URL of a receipt's image at the given size ("thumbnail", "preview" or "full"). Pages that show a list of
+# receipts look up all their URLs at once with get_receipt_image_urls() and keep them in receipt.image_urls (see
+# get_claim_details_context), so only receipts without one are looked up here.
+@register.simple_tag
+def receipt_image_url(receipt, size="full"):
+    image_urls = getattr(receipt, "image_urls", {})
+    if size in image_urls:
+        return image_urls[size]
+    return get_receipt_image_urls([receipt], size)[0]
@@ -0,0 +1,549 @@
+import datetime
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from expensesapp.admission import AdmissionGate, get_admission_metrics, limit_upload_concurrency
+from expensesapp.custom import ReferenceBlocks, handle_uploaded_file
+from expensesapp.duplicates import receipt_image_index, reset_receipt_image_index
+from expensesapp.jobs import (enqueue_receipt_image, process_due_file_deletions, process_due_jobs,
+                              remove_orphaned_spool_files, run_job)
+from expensesapp.models import *
+from expensesapp.pagination import KeysetPaginator
+from expensesapp.reference_data import ReferenceTable
+from expensesapp.storage import LocalReceiptStorage
+from expensesapp.uploads import ReceiptUploadHandler
+
+
+def make_image_upload(colour=(200, 10, 10), size=(400, 300)):
+    blob = BytesIO()
+    Image.new("RGB", size, colour).save(blob, "JPEG")
+    return SimpleUploadedFile("photo.jpg", blob.getvalue(), content_type="image/jpeg")
+
+
+# Stores files in a temporary directory rather than in the configured storage
+class MediaTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(DEFAULT_FILE_STORAGE="expensesapp.storage.LocalReceiptStorage",
+                                           MEDIA_ROOT=media_root, RECEIPT_IMAGE_SPOOL_DIR=media_root + "/spool",
+                                           RECEIPT_IMAGE_WORKERS=0)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        reset_receipt_image_index()
+        # The in-memory currency and category tables are only read again once the change commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.currency = Currency.objects.create(name="Pound", iso_code="GBP", symbol="£", vat_name="1")
+            self.category = Category.objects.create(name="Travel")
+        self.user = User.objects.create_user(email="claimant@example.com", username="claimant", password="password",
+                                             default_currency=self.currency)
+        self.claim = Claim.create(self.user, self.currency, "Trip")
+        self.claim.save()
+
+    def create_receipt(self):
+        receipt = Receipt.create(self.claim, self.category, datetime.date(2022, 1, 1), 10, 2, "Train")
+        receipt.save()
+        return receipt
+
+
+class ReceiptImageJobTests(MediaTestCase):
+
+    # A receipt that is deleted while its image is being processed mustn't take away the image of another receipt
+    # that uses the same stored file
+    def test_deleted_receipt_keeps_shared_image(self):
+        receipt_a = self.create_receipt()
+        handle_uploaded_file(make_image_upload(), receipt_a)
+        receipt_a.image_status = "2"
+        receipt_a.save()
+        receipt_b = self.create_receipt()
+        with self.captureOnCommitCallbacks():
+            enqueue_receipt_image(receipt_b, make_image_upload())
+        job = ReceiptImageJob.objects.select_related("receipt").get(receipt=receipt_b)
+        job.status = "2"
+        Receipt.objects.filter(pk=receipt_b.pk).delete()
+
+        run_job(job)
+
+        blob = ReceiptImageBlob.objects.get(file_name=receipt_a.file.name)
+        self.assertEqual(blob.reference_count, 1)
+        self.assertFalse(FileDeletion.objects.filter(file_name=receipt_a.file.name).exists())
+        self.assertTrue(receipt_a.file.storage.exists(receipt_a.file.name))
+
+    # Uploads wait for their jobs in the media storage, so a worker on another machine can process them, and they're
+    # deleted once the image has been stored
+    def test_job_reads_upload_from_media_storage(self):
+        receipt = self.create_receipt()
+        with self.captureOnCommitCallbacks():
+            job = enqueue_receipt_image(receipt, make_image_upload())
+        storage = receipt.file.storage
+        self.assertTrue(storage.exists(job.spool_path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            process_due_jobs()
+
+        receipt.refresh_from_db()
+        self.assertEqual(receipt.image_status, "2")
+        self.assertTrue(storage.exists(receipt.file.name))
+        self.assertFalse(storage.exists(job.spool_path))
+
+    # Spooled uploads whose jobs have gone are deleted once they're old enough not to belong to a job that is still
+    # being committed
+    def test_orphaned_spool_files_are_deleted(self):
+        receipt = self.create_receipt()
+        with self.captureOnCommitCallbacks():
+            job = enqueue_receipt_image(receipt, make_image_upload())
+        Receipt.objects.filter(pk=receipt.pk).delete()
+
+        remove_orphaned_spool_files()
+        self.assertFalse(FileDeletion.objects.filter(file_name=job.spool_path).exists())
+        remove_orphaned_spool_files(min_age=-60)
+        self.assertTrue(FileDeletion.objects.filter(file_name=job.spool_path).exists())
+
+    # A claim submitted while one of its images was still processing is flagged once the image turns out to match
+    # another receipt's
+    def test_duplicate_found_after_submission(self):
+        other_receipt = self.create_receipt()
+        handle_uploaded_file(make_image_upload(), other_receipt)
+        other_receipt.save()
+        claim = Claim.create(self.user, self.currency, "Second trip")
+        claim.save()
+        receipt = Receipt.create(claim, self.category, datetime.date(2022, 1, 2), 10, 2, "Train")
+        receipt.save()
+        with self.captureOnCommitCallbacks():
+            enqueue_receipt_image(receipt, make_image_upload(colour=(201, 10, 10)))
+        claim.submit()
+        claim.save()
+
+        process_due_jobs()
+
+        claim.refresh_from_db()
+        self.assertTrue(claim.possible_duplicates)
+
+    # Receipts whose images never finished processing don't keep the index reading every receipt after them
+    def test_image_index_skips_stuck_receipts(self):
+        stuck_receipt = self.create_receipt()
+        Receipt.objects.filter(pk=stuck_receipt.pk).update(
+            image_status="1", creation_datetime=stuck_receipt.creation_datetime - datetime.timedelta(days=1))
+        latest_receipt = self.create_receipt()
+        receipt_image_index.sync()
+        self.assertEqual(receipt_image_index.complete_up_to_id, latest_receipt.pk)
+
+
+class ReceiptUploadTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        self.url = reverse("expensesapp:receipt_new", args=[self.claim.reference])
+
+    def get_form_data(self, upload):
+        return {"claim": self.claim.reference, "date_incurred": "2022-01-01", "category": "Travel", "amount": "10.00",
+                "vat": "2.00", "description": "Train", "file": upload}
+
+    def test_valid_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, self.get_form_data(make_image_upload()))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Receipt.objects.get(claim=self.claim).image_status, "2")
+
+    # Files are checked from their first bytes rather than their name or content type
+    def test_file_that_is_not_an_image(self):
+        upload = SimpleUploadedFile("photo.jpg", b"%PDF-1.4 not an image", content_type="image/jpeg")
+        response = self.client.post(self.url, self.get_form_data(upload))
+        self.assertContains(response, "Upload a JPEG, PNG, GIF, WebP, AVIF, BMP or TIFF image.")
+        self.assertFalse(Receipt.objects.exists())
+
+    @override_settings(RECEIPT_UPLOAD_MAX_FILE_SIZE=2 ** 20)
+    def test_file_too_large(self):
+        upload = SimpleUploadedFile("photo.jpg", b"\xff\xd8\xff" + bytes(2 ** 20), content_type="image/jpeg")
+        response = self.client.post(self.url, self.get_form_data(upload))
+        self.assertContains(response, "Upload an image no larger than 1 MB.")
+        self.assertFalse(Receipt.objects.exists())
+
+    # Requests that say they're too big are turned away before any of the body is read
+    @override_settings(RECEIPT_UPLOAD_MAX_REQUEST_SIZE=2 ** 20)
+    def test_request_too_large(self):
+        upload = SimpleUploadedFile("photo.jpg", b"\xff\xd8\xff" + bytes(2 ** 20), content_type="image/jpeg")
+        with mock.patch.object(ReceiptUploadHandler, "new_file") as new_file:
+            response = self.client.post(self.url, self.get_form_data(upload))
+        self.assertEqual(response.status_code, 413)
+        new_file.assert_not_called()
+
+    # Returns a client that is checked for a CSRF token like a browser, along with a valid token
+    def get_csrf_client(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        client.get(self.url)
+        return client, client.cookies["csrftoken"].value
+
+    # Users who can't add receipts to the claim are turned away before their files are read, even by the CSRF check
+    def test_other_users_upload_rejected_before_reading(self):
+        other_user = User.objects.create_user(email="other@example.com", username="other", password="password")
+        client, csrf_token = self.get_csrf_client()
+        client.force_login(other_user)
+        form_data = dict(self.get_form_data(make_image_upload()), csrfmiddlewaretoken=csrf_token)
+        with mock.patch.object(ReceiptUploadHandler, "new_file") as new_file:
+            response = client.post(self.url, form_data)
+        self.assertContains(response, "Access denied!")
+        new_file.assert_not_called()
+        self.assertFalse(Receipt.objects.exists())
+
+    # The CSRF check is made by receipt_upload rather than the middleware, which mustn't let uploads through without
+    # a token
+    def test_csrf_token_required(self):
+        client, csrf_token = self.get_csrf_client()
+        self.assertEqual(client.post(self.url, self.get_form_data(make_image_upload())).status_code, 403)
+        form_data = dict(self.get_form_data(make_image_upload()), csrfmiddlewaretoken=csrf_token)
+        self.assertEqual(client.post(self.url, form_data).status_code, 302)
+        self.assertTrue(Receipt.objects.exists())
+
+
+class ReceiptBatchTests(MediaTestCase):
+
+    # A line whose only input was a file that the upload handler turned away is shown again with the reason, rather
+    # than being dropped as blank
+    def test_line_with_only_rejected_file_is_kept(self):
+        self.client.force_login(self.user)
+        form_data = {"form-TOTAL_FORMS": 2, "form-INITIAL_FORMS": 0,
+                     "form-0-date_incurred": "2022-01-01", "form-0-category": "Travel", "form-0-amount": "10.00",
+                     "form-0-vat": "2.00", "form-0-description": "Train", "form-0-file": make_image_upload(),
+                     "form-1-date_incurred": "2022-01-01", "form-1-category": "Travel",
+                     "form-1-file": SimpleUploadedFile("notes.jpg", b"%PDF-1.4", content_type="image/jpeg")}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("expensesapp:receipt_batch_new", args=[self.claim.reference]),
+                                        form_data)
+
+        self.assertContains(response, "Upload a JPEG, PNG, GIF, WebP, AVIF, BMP or TIFF image.")
+        self.assertEqual(len(response.context["added_receipts"]), 1)
+        self.assertEqual(Receipt.objects.filter(claim=self.claim).count(), 1)
+
+
+class LocalStorageTests(MediaTestCase):
+
+    # Files are served from the storage's memory map, only to requests with a valid signature
+    def test_media_view_serves_signed_urls(self):
+        receipt = self.create_receipt()
+        handle_uploaded_file(make_image_upload(), receipt)
+        storage = receipt.file.storage
+        url = storage.url(receipt.file.name)
+
+        with mock.patch.object(LocalReceiptStorage, "_open", wraps=storage._open) as storage_open:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        with open(storage.path(receipt.file.name), "rb") as stored_file:
+            stored_content = stored_file.read()
+        self.assertEqual(b"".join(response.streaming_content), stored_content)
+        self.assertEqual(int(response["Content-Length"]), len(stored_content))
+        storage_open.assert_called_once()
+        self.assertEqual(self.client.get(url.replace("signature=", "signature=0")).status_code, 404)
+
+
+    # Filesystems without hard links get a copy of the saved file instead, which still never replaces another file
+    def test_save_without_hard_links(self):
+        storage = LocalReceiptStorage()
+        first_name = storage.save("receipt.jpeg", ContentFile(b"first"))
+        with mock.patch("os.link", side_effect=PermissionError("Hard links not supported")):
+            second_name = storage.save("receipt.jpeg", ContentFile(b"second"))
+        self.assertNotEqual(first_name, second_name)
+        with storage.open(first_name) as first_file, storage.open(second_name) as second_file:
+            self.assertEqual((first_file.read(), second_file.read()), (b"first", b"second"))
+        self.assertEqual(sorted(storage.listdir("")[1]), sorted([first_name, second_name]))
+
+
+class FileDeletionTests(MediaTestCase):
+
+    def create_receipt_with_image(self):
+        receipt = self.create_receipt()
+        handle_uploaded_file(make_image_upload(), receipt)
+        receipt.save()
+        return receipt
+
+    def get_stored_names(self, receipt):
+        storage = receipt.file.storage
+        return [file_name for file_name in storage.listdir("")[1] if file_name.startswith(receipt.file.name[:64])]
+
+    # Receipts with the same upload share one stored image, which is only deleted along with the last of them
+    def test_shared_image_deleted_with_last_receipt(self):
+        receipt_a = self.create_receipt_with_image()
+        receipt_b = self.create_receipt_with_image()
+        self.assertEqual(receipt_a.file.name, receipt_b.file.name)
+        stored_names = self.get_stored_names(receipt_a)
+        self.assertEqual(len(stored_names), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            receipt_a.delete()
+
+        self.assertEqual(ReceiptImageBlob.objects.get(file_name=receipt_b.file.name).reference_count, 1)
+        self.assertFalse(FileDeletion.objects.exists())
+        self.assertEqual(self.get_stored_names(receipt_b), stored_names)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            receipt_b.delete()
+
+        self.assertFalse(ReceiptImageBlob.objects.exists())
+        self.assertFalse(FileDeletion.objects.exists())
+        self.assertFalse(any(receipt_b.file.storage.exists(file_name) for file_name in stored_names))
+
+    # Files that can't be deleted stay queued with the error, and are deleted when they're next due
+    def test_failed_deletion_is_retried(self):
+        receipt = self.create_receipt_with_image()
+        storage = receipt.file.storage
+        stored_names = self.get_stored_names(receipt)
+
+        with mock.patch.object(LocalReceiptStorage, "delete", side_effect=OSError("Storage unavailable")), \
+                self.assertLogs("expensesapp.jobs", "WARNING"), self.captureOnCommitCallbacks(execute=True):
+            receipt.delete()
+
+        deletions = FileDeletion.objects.all()
+        self.assertEqual(sorted(deletion.file_name for deletion in deletions), sorted(stored_names))
+        self.assertTrue(all(deletion.attempts == 1 and "Storage unavailable" in deletion.last_error
+                            and deletion.run_after_datetime > timezone.now() for deletion in deletions))
+        self.assertTrue(all(storage.exists(file_name) for file_name in stored_names))
+        self.assertEqual(process_due_file_deletions(), 0)
+
+        FileDeletion.objects.update(run_after_datetime=timezone.now())
+        self.assertEqual(process_due_file_deletions(), len(stored_names))
+
+        self.assertFalse(FileDeletion.objects.exists())
+        self.assertFalse(any(storage.exists(file_name) for file_name in stored_names))
+
+
+class ReceiptImageUrlTests(MediaTestCase):
+
+    # The claim page's thumbnail column looks up every receipt's URL with one cache lookup, rather than one each
+    def test_claim_page_looks_up_thumbnails_together(self):
+        for colour in [(200, 10, 10), (10, 200, 10), (10, 10, 200)]:
+            receipt = self.create_receipt()
+            handle_uploaded_file(make_image_upload(colour), receipt)
+            receipt.save()
+        self.client.force_login(self.user)
+
+        with mock.patch("expensesapp.receipt_images.cache", wraps=cache) as image_cache:
+            response = self.client.get(reverse("expensesapp:claim_details", args=[self.claim.reference]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count(b".thumbnail.jpeg?"), 3)
+        self.assertEqual(image_cache.get_many.call_count, 1)
+        self.assertEqual(image_cache.get.call_count, 0)
+
+
+class ClaimSummaryTests(MediaTestCase):
+
+    # Saving a claim that was loaded before one of its receipts was added keeps the summary the receipt wrote
+    def test_saving_stale_claim_keeps_summary(self):
+        stale_claim = Claim.objects.get(pk=self.claim.pk)
+        self.create_receipt()
+        stale_claim.description = "Trip to Leeds"
+        stale_claim.save()
+
+        claim = Claim.objects.get(pk=self.claim.pk)
+        self.assertEqual(claim.description, "Trip to Leeds")
+        self.assertEqual(claim.receipts_count, 1)
+        self.assertEqual(claim.total_amount, 10)
+        self.assertTrue(claim.is_summary_current())
+
+
+class AdmissionTests(TestCase):
+
+    # Uploads let through and turned away are counted in the database, so every process adds to the same totals
+    def test_admissions_counted(self):
+        view = limit_upload_concurrency(lambda request: HttpResponse())
+        request = RequestFactory().post("/")
+        request.user = AnonymousUser()
+        view(request)
+        view(request)
+        with mock.patch.object(AdmissionGate, "acquire", return_value=None):
+            response = view(request)
+        view(RequestFactory().get("/"))
+
+        self.assertEqual(response.status_code, 503)
+        metrics = get_admission_metrics()
+        self.assertEqual((metrics["admitted"], metrics["rejected"]), (2, 1))
+        self.assertEqual(AdmissionCounter.objects.count(), 1)
+
+
+class KeysetPaginationTests(TestCase):
+
+    # 23 claims over 5 pages, with only three distinct timestamps so that most rows tie on the first sort key
+    def setUp(self):
+        # Users in earlier tests may have had the same IDs, and their cached claim counts with them
+        cache.clear()
+        currency = Currency.objects.create(name="Pound", iso_code="GBP", symbol="£", vat_name="1")
+        self.user = User.objects.create_user(email="claimant@example.com", username="claimant", password="password")
+        for claim_num in range(23):
+            Claim.create(self.user, currency, "Claim {0}".format(claim_num)).save()
+        start = timezone.now()
+        for claim in Claim.objects.all():
+            Claim.objects.filter(pk=claim.pk).update(
+                status_update_datetime=start - datetime.timedelta(hours=claim.pk % 3))
+        self.queryset = Claim.objects.all()
+        self.ordering = ["-status_update_datetime", "-id"]
+        self.expected = list(self.queryset.order_by(*self.ordering))
+
+    def get_paginator(self):
+        return KeysetPaginator(self.queryset, self.ordering, 5)
+
+    def follow(self, link):
+        return self.get_paginator().get_page(link["number"], link["cursor"])
+
+    def test_walk_forwards(self):
+        page = self.get_paginator().get_page(1)
+        claims = list(page.object_list)
+        while page.get_navigation()["next_page"]:
+            page = self.follow(page.get_navigation()["next_page"])
+            claims += page.object_list
+        self.assertEqual(page.number, 5)
+        self.assertEqual(claims, self.expected)
+
+    def test_walk_backwards(self):
+        page = self.get_paginator().get_page(5)
+        claims = list(page.object_list)
+        while page.get_navigation()["previous_page"]:
+            page = self.follow(page.get_navigation()["previous_page"])
+            claims = page.object_list + claims
+        self.assertEqual(page.number, 1)
+        self.assertEqual(claims, self.expected)
+
+    # Links skip over whole pages from the edge of the current one, in either direction
+    def test_jump_between_pages(self):
+        page = self.get_paginator().get_page(1)
+        page = self.follow([link for link in page.get_navigation()["clickable_pages"] if link["number"] == 3][0])
+        self.assertEqual(page.object_list, self.expected[10:15])
+        page = self.follow(page.get_link(5))
+        self.assertEqual(page.object_list, self.expected[20:])
+        page = self.follow(page.get_link(2))
+        self.assertEqual(page.object_list, self.expected[5:10])
+        page = self.follow(page.get_link(4))
+        self.assertEqual(page.object_list, self.expected[15:20])
+
+    # The back link returns to the list page that was last viewed, cursor and all, which shows the same claims
+    def test_back_link_returns_to_page(self):
+        for claim_num in range(15):
+            Claim.create(self.user, Currency.objects.get(), "Extra claim {0}".format(claim_num)).save()
+        expected = list(self.queryset.order_by(*self.ordering))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("expensesapp:your_expenses", args=["all", 1]))
+        next_page = response.context["next_page"]
+        self.assertIsNotNone(next_page["cursor"])
+        page_url = "{0}?cursor={1}".format(reverse("expensesapp:your_expenses", args=["all", 2]), next_page["cursor"])
+        response = self.client.get(page_url)
+        self.assertEqual(response.context["claim_list"], expected[15:30])
+
+        response = self.client.get(reverse("expensesapp:back"))
+        self.assertEqual(response["Location"], page_url)
+        self.assertEqual(self.client.get(response["Location"]).context["claim_list"], expected[15:30])
+
+    # Pages typed in without a cursor, or with one that has been tampered with, are fetched by offset
+    def test_page_without_valid_cursor(self):
+        link = self.get_paginator().get_page(1).get_link(3)
+        self.assertEqual(self.get_paginator().get_page(3).object_list, self.expected[10:15])
+        self.assertEqual(self.get_paginator().get_page(3, link["cursor"] + "x").object_list, self.expected[10:15])
+
+
+class ReferenceTests(TestCase):
+
+    # A block of references reserved in a transaction that rolls back goes back to the counter, so the process that
+    # reserved it mustn't hand it out as well as the next process to reserve one
+    def test_block_reserved_in_rolled_back_transaction_is_dropped(self):
+        first_process = ReferenceBlocks()
+        try:
+            with transaction.atomic():
+                first_process.take("expensesapp.receipt", 1)
+                raise IntegrityError()
+        except IntegrityError:
+            pass
+        second_process = ReferenceBlocks()
+        second_values = second_process.take("expensesapp.receipt", 2)[0]
+        first_values = first_process.take("expensesapp.receipt", 2)[0]
+        self.assertFalse(set(first_values) & set(second_values))
+
+
+class UserRoleTests(TestCase):
+
+    # Users in earlier tests may have had the same IDs
+    def setUp(self):
+        cache.clear()
+
+    # Every page shows the user's role, which is read along with its version in a single cache lookup, and is worked
+    # out again once a claim it counts changes
+    def test_role_read_with_one_cache_lookup(self):
+        currency = Currency.objects.create(name="Pound", iso_code="GBP", symbol="£", vat_name="1")
+        manager = User.objects.create_user(email="manager@example.com", username="manager", password="password")
+        member = User.objects.create_user(email="member@example.com", username="member", password="password",
+                                          primary_manager=manager, default_currency=currency)
+        self.assertEqual(User.objects.get(pk=manager.pk).get_role()["pending_claims_count"], 0)
+
+        with mock.patch("expensesapp.caching.cache", wraps=cache) as role_cache:
+            self.assertTrue(User.objects.get(pk=manager.pk).get_role()["is_manager"])
+        self.assertEqual(role_cache.get_many.call_count + role_cache.get.call_count, 1)
+
+        claim = Claim.create(member, currency, "Trip")
+        claim.submit()
+        with self.captureOnCommitCallbacks(execute=True):
+            claim.save()
+        self.assertEqual(User.objects.get(pk=manager.pk).get_role()["pending_claims_count"], 1)
+
+
+class ClaimRowTests(MediaTestCase):
+
+    # A page of claims looks up the versions of all its cached rows at once, once they've been started
+    def test_row_versions_fetched_together(self):
+        for description in ["Second trip", "Third trip"]:
+            Claim.create(self.user, self.currency, description).save()
+        self.client.force_login(self.user)
+        self.client.get(reverse("expensesapp:your_expenses", args=["all", 1]))
+
+        with mock.patch("expensesapp.caching.cache", wraps=cache) as version_cache:
+            response = self.client.get(reverse("expensesapp:your_expenses", args=["all", 1]))
+
+        self.assertEqual(response.status_code, 200)
+        row_lookups = [call for call in version_cache.get.call_args_list + version_cache.get_many.call_args_list
+                       if "claim_row" in str(call.args[0])]
+        self.assertEqual(len(row_lookups), 1)
+        self.assertEqual(len(row_lookups[0].args[0]), 3)
+
+
+class ReferenceTableTests(TestCase):
+
+    # The table's version is looked up at most once per check interval, and changes made by this process show up
+    # as soon as they're committed
+    def test_version_checked_once_per_interval(self):
+        table = ReferenceTable(Category)
+        with mock.patch("expensesapp.reference_data.get_version", return_value=1) as get_version:
+            self.assertEqual(table.all(), [])
+            self.assertEqual(table.get_choices(), [])
+        self.assertEqual(get_version.call_count, 1)
+
+        with mock.patch.dict("expensesapp.reference_data.reference_tables", {Category: table}), \
+                self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name="Travel")
+
+        self.assertEqual(table.get_choices(), [("Travel", "Travel")])
+
+
+class QueryPlanTests(TestCase):
+
+    # The main list and detail page queries must all be able to use an index (see check_query_plans)
+    def test_no_full_table_scans(self):
+        output = StringIO()
+        try:
+            call_command("check_query_plans", stdout=output)
+        except CommandError as error:
+            self.fail("{0}\n{1}".format(error, output.getvalue()))
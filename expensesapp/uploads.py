@@ -0,0 +1,114 @@
+import os
+import tempfile
+from functools import wraps
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+# The first bytes of each image format that receipts can be uploaded in
+IMAGE_SIGNATURES = [
+    (0, b"\xff\xd8\xff"),  # JPEG
+    (0, b"\x89PNG\r\n\x1a\n"),  # PNG
+    (0, b"GIF87a"),
+    (0, b"GIF89a"),
+    (0, b"BM"),  # BMP
+    (0, b"II*\x00"),  # TIFF, little-endian
+    (0, b"MM\x00*"),  # TIFF, big-endian
+    (8, b"WEBP"),  # After "RIFF" and the file size
+    (4, b"ftypavif"),
+]
+
+
+def is_image_header(data):
+    return any(data[offset:offset + len(signature)] == signature for offset, signature in IMAGE_SIGNATURES)
+
+
+# An upload that is written to a temporary file in the receipt image spool directory, which is deleted when it's closed
+# at the end of the request
+class SpooledUploadedFile(UploadedFile):
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        os.makedirs(settings.RECEIPT_IMAGE_SPOOL_DIR, exist_ok=True)
+        file_descriptor, self.spool_path = tempfile.mkstemp(dir=settings.RECEIPT_IMAGE_SPOOL_DIR,
+                                                            suffix=os.path.splitext(name)[1])
+        super().__init__(os.fdopen(file_descriptor, "w+b"), name, content_type, size, charset, content_type_extra)
+
+    # Lets form validation open the image from disk instead of reading it into memory
+    def temporary_file_path(self):
+        return self.spool_path
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            try:
+                os.remove(self.spool_path)
+            except FileNotFoundError:
+                pass
+
+
+# Streams receipt images to spooled files, rejecting any that are too big or don't start like an image as soon as
+# that's known, rather than after the whole file has arrived. The reasons are kept in request.receipt_upload_errors
+# (by field name) for the forms to report.
+class ReceiptUploadHandler(FileUploadHandler):
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.errors = {}
+        if request is not None:
+            request.receipt_upload_errors = self.errors
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.file = SpooledUploadedFile(file_name, content_type, 0, charset, content_type_extra)
+        if content_length and content_length > settings.RECEIPT_UPLOAD_MAX_FILE_SIZE:
+            self.reject_file()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0 and not is_image_header(raw_data):
+            self.reject_file("Upload a JPEG, PNG, GIF, WebP, AVIF, BMP or TIFF image.")
+        if start + len(raw_data) > settings.RECEIPT_UPLOAD_MAX_FILE_SIZE:
+            self.reject_file()
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        return self.file
+
+    def upload_interrupted(self):
+        self.file.close()
+
+    def reject_file(self, message=None):
+        if message is None:
+            message = "Upload an image no larger than {0} MB.".format(settings.RECEIPT_UPLOAD_MAX_FILE_SIZE // 2 ** 20)
+        self.errors[self.field_name] = message
+        # The parser closes self.file again when it skips the rest of the file, which is harmless
+        self.file.close()
+        raise SkipFile()
+
+
+# Makes a view that takes receipt images use ReceiptUploadHandler, and turns away requests that are too big from
+# their Content-Length before reading the body. Upload handlers can only be changed before the CSRF check reads the
+# form, so the check is done here instead of by the middleware. Permission checks go outside this decorator, so that
+# users who can't upload are turned away before their files are read.
+def receipt_upload(view):
+    protected_view = csrf_protect(view)
+
+    @csrf_exempt
+    @wraps(view)
+    def wrapped_view(request, *args, **kwargs):
+        if request.method == "POST":
+            try:
+                content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                content_length = 0
+            if content_length > settings.RECEIPT_UPLOAD_MAX_REQUEST_SIZE:
+                return render(request, "expensesapp/upload_too_large.html",
+                              {"max_size": settings.RECEIPT_UPLOAD_MAX_REQUEST_SIZE // 2 ** 20}, status=413)
+            request.upload_handlers = [ReceiptUploadHandler(request)]
+        return protected_view(request, *args, **kwargs)
+
+    return wrapped_view
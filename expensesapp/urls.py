@@ -11,7 +11,10 @@ urlpatterns = [
     path("claims/<str:claim_ref>/edit/", views.claim_edit_view, name="claim_edit"),
     path("claims/<str:claim_ref>/delete/", views.claim_delete_view, name="claim_delete"),
     path("claims/<str:claim_ref>/new-receipt", views.receipt_new_view, name="receipt_new"),
+    path("claims/<str:claim_ref>/new-receipts/", views.receipt_batch_new_view, name="receipt_batch_new"),
     path("receipts/<str:receipt_ref>/", views.receipt_details_view, name="receipt_details"),
+    path("receipts/<str:receipt_ref>/image/<str:size>/", views.receipt_image_view, name="receipt_image"),
+    path("receipts/<str:receipt_ref>/image-status/", views.receipt_image_status_view, name="receipt_image_status"),
     path("receipts/<str:receipt_ref>/edit/", views.receipt_edit_view, name="receipt_edit"),
     path("receipts/<str:receipt_ref>/delete/", views.receipt_delete_view, name="receipt_delete"),
     path("claims/<str:claim_ref>/submit/", views.claim_submit_view, name="claim_submit"),
@@ -20,4 +23,6 @@ urlpatterns = [
     path("claims/<str:claim_ref>/return/", views.claim_return_view, name="claim_return"),
     path("claims/<str:claim_ref>/approve/", views.claim_approve_view, name="claim_approve"),
     path("back/", views.back_view, name="back"),
+    path("metrics/uploads/", views.upload_metrics_view, name="upload_metrics"),
+    path("media/<path:file_name>", views.media_view, name="media"),
 ]
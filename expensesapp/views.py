@@ -1,14 +1,28 @@
-import math
-
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render
 from django.urls import reverse
+from django.utils.http import url_has_allowed_host_and_scheme
 from django.views.generic import TemplateView
 from django.contrib.auth.mixins import LoginRequiredMixin
 
 from expensesapp.models import *
 from expensesapp.forms import *
+from expensesapp.admission import get_admission_metrics, limit_upload_concurrency
+from expensesapp.storage import LocalReceiptStorage, get_storage_timings
+from expensesapp.duplicates import find_duplicate_receipts
+from expensesapp.jobs import enqueue_receipt_image, enqueue_receipt_images
+from expensesapp.pagination import KeysetPaginator
+from expensesapp.permissions import claim_permission_required, get_claim_permissions, not_found, \
+    receipt_permission_required
+from expensesapp.receipt_images import RECEIPT_IMAGE_SIZES, get_or_create_derivative, get_receipt_image_urls
+from expensesapp.reference_data import category_table, currency_table
+from expensesapp.uploads import receipt_upload
+
+
+# Receipts along with what their details page shows
+receipts_with_details = Receipt.objects.select_related("category", "claim__owner", "claim__currency")
 
 
 class AccessDeniedView(LoginRequiredMixin, TemplateView):
@@ -37,7 +51,7 @@ def account_edit_view(request):
         account_edit_form = AccountEditForm(request.POST,default_currency=default_currency,
                                             substitute_email=substitute_email)
         if account_edit_form.is_valid():
-            new_default_currency = Currency.objects.get(name=account_edit_form.cleaned_data["default_currency"])
+            new_default_currency = currency_table.get(account_edit_form.cleaned_data["default_currency"])
             request.user.default_currency = new_default_currency
             new_substitute_email = account_edit_form.cleaned_data["substitute_email"]
             if new_substitute_email:
@@ -57,7 +71,7 @@ def claim_new_view(request):
     if request.method == "POST":
         claim_new_form = ClaimNewForm(request.POST, default_currency=default_currency)
         if claim_new_form.is_valid():
-            currency = Currency.objects.get(name=claim_new_form.cleaned_data['currency'])
+            currency = currency_table.get(claim_new_form.cleaned_data['currency'])
             description = claim_new_form.cleaned_data['description']
             new_claim = Claim.create(request.user, currency, description)
             new_claim.save()
@@ -68,54 +82,47 @@ def claim_new_view(request):
 
 
 @login_required
-def claim_details_view(request, claim_ref):
-
-    # Check that the claim exists
-    try:
-        claim = Claim.objects.get(reference=claim_ref)
-    except Claim.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that user has permission to access this claim
-    if not claim.user_can_view(request.user):
-        return render(request, "expensesapp/access_denied.html")
-
-    claim_delete_form = ClaimDeleteForm(claim_ref=claim_ref)
-    claim_submit_form = ClaimSubmitForm(claim_ref=claim_ref)
-    all_teams_pending_claims = request.user.get_all_teams_pending_claims()
-    if all_teams_pending_claims:
-        if (claim.status == "2") and (claim in request.user.get_all_teams_pending_claims()):
-            claim_return_form = ClaimReturnForm()
-            claim_approve_form = ClaimApproveForm(claim_ref=claim_ref)
-        else:
-            claim_return_form = None
-            claim_approve_form = None
+@claim_permission_required("view", queryset=Claim.objects.with_details())
+def claim_details_view(request, claim):
+    context = get_claim_details_context(claim)
+    claim_delete_form = ClaimDeleteForm(claim_ref=claim.reference)
+    claim_submit_form = ClaimSubmitForm(claim_ref=claim.reference)
+    if get_claim_permissions(request).can_review(claim):
+        claim_return_form = ClaimReturnForm()
+        claim_approve_form = ClaimApproveForm(claim_ref=claim.reference)
     else:
         claim_return_form = None
         claim_approve_form = None
-    return render(request, "expensesapp/claim_details.html", {"claim": claim, "claim_delete_form": claim_delete_form,
-                                                              "claim_submit_form": claim_submit_form,
-                                                              "claim_return_form": claim_return_form,
-                                                              "claim_approve_form": claim_approve_form})
 
+    # Flag receipts that look like other receipts. Only the approving manager sees matches in other people's claims.
+    duplicates = []
+    for receipt, duplicate_receipts in find_duplicate_receipts(context["receipts"]).items():
+        if claim_approve_form is None:
+            duplicate_receipts = [duplicate for duplicate in duplicate_receipts
+                                  if duplicate.claim.owner_id == request.user.id]
+        if duplicate_receipts:
+            duplicates.append({"receipt": receipt, "duplicate_receipts": duplicate_receipts})
+    context.update({"duplicates": duplicates, "claim_delete_form": claim_delete_form,
+                    "claim_submit_form": claim_submit_form, "claim_return_form": claim_return_form,
+                    "claim_approve_form": claim_approve_form})
+    return render(request, "expensesapp/claim_details.html", context)
+
+
+# The context that claim_details.html (and claim_edit.html, which extends it) needs for a claim fetched with
+# Claim.objects.with_details(), so that the templates don't query for anything else
+def get_claim_details_context(claim):
+    receipts = list(claim.receipts.all())
+    # The thumbnail column's URLs, which are looked up together rather than one receipt at a time
+    receipts_with_images = [receipt for receipt in receipts if receipt.file]
+    for receipt, url in zip(receipts_with_images, get_receipt_image_urls(receipts_with_images, "thumbnail")):
+        receipt.image_urls = {"thumbnail": url}
+    return {"claim": claim, "receipts": receipts,
+            "latest_feedback": claim.get_latest_feedback() if claim.status == "5" else None}
 
-@login_required
-def claim_edit_view(request, claim_ref):
-
-    # Check that the claim exists
-    try:
-        claim = Claim.objects.get(reference=claim_ref)
-    except Claim.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that user has permission to edit this claim (only the owner has this permission)
-    if not claim.owner == request.user:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that claim status is editable
-    if not claim.is_editable():
-        return render(request, "expensesapp/access_denied.html")
 
+@login_required
+@claim_permission_required("edit", queryset=Claim.objects.with_details())
+def claim_edit_view(request, claim):
     if request.method == "POST":
         claim_edit_form = ClaimEditForm(request.POST, description=claim.description)
         if claim_edit_form.is_valid():
@@ -125,28 +132,16 @@ def claim_edit_view(request, claim_ref):
             return HttpResponseRedirect(reverse("expensesapp:claim_details", args=[claim.reference]))
     else:
         claim_edit_form = ClaimEditForm(description=claim.description)
-    return render(request, "expensesapp/claim_edit.html", {"claim": claim, "claim_edit_form": claim_edit_form})
+    context = get_claim_details_context(claim)
+    context["claim_edit_form"] = claim_edit_form
+    return render(request, "expensesapp/claim_edit.html", context)
 
 
 @login_required
-def claim_delete_view(request, claim_ref):
-
-    # Check that the claim exists
-    try:
-        claim = Claim.objects.get(reference=claim_ref)
-    except Claim.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that user has permission to delete this claim (only the owner has this permission)
-    if not claim.owner == request.user:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that claim status is editable
-    if not claim.is_editable():
-        return render(request, "expensesapp/access_denied.html")
-
+@claim_permission_required("edit")
+def claim_delete_view(request, claim):
     if request.method == "POST":
-        claim_delete_form = ClaimDeleteForm(request.POST, claim_ref=claim_ref)
+        claim_delete_form = ClaimDeleteForm(request.POST, claim_ref=claim.reference)
         if claim_delete_form.is_valid():
             claim.delete()
             return HttpResponseRedirect(reverse("expensesapp:home"))
@@ -154,87 +149,164 @@ def claim_delete_view(request, claim_ref):
 
 
 @login_required
-def receipt_new_view(request, claim_ref):
-
-    # Check that the claim exists
-    try:
-        claim = Claim.objects.get(reference=claim_ref)
-    except Claim.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that user has permission to add a receipt to this claim (only the owner has this permission)
-    if not claim.owner == request.user:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that claim status is editable
-    if not claim.is_editable():
-        return render(request, "expensesapp/access_denied.html")
-
-    categories = Category.objects.order_by("name")
+@claim_permission_required("edit")
+@limit_upload_concurrency
+@receipt_upload
+def receipt_new_view(request, claim):
     if request.method == "POST":
-        receipt_new_form = ReceiptNewForm(request.POST, request.FILES, claim_ref=claim_ref, categories=categories)
+        receipt_new_form = ReceiptNewForm(request.POST, request.FILES, claim_ref=claim.reference,
+                                          upload_errors=request.receipt_upload_errors)
         if receipt_new_form.is_valid():
-            claim = Claim.objects.get(reference=receipt_new_form.cleaned_data["claim"])
-            category = Category.objects.get(name=receipt_new_form.cleaned_data["category"])
+            category = category_table.get(receipt_new_form.cleaned_data["category"])
             date_incurred = receipt_new_form.cleaned_data["date_incurred"]
             amount = receipt_new_form.cleaned_data["amount"]
             vat = receipt_new_form.cleaned_data["vat"]
             description = receipt_new_form.cleaned_data["description"]
-            new_receipt = Receipt.create(claim, category, date_incurred, amount, vat, description)
-            new_receipt.save()
-            handle_uploaded_file(request.FILES["file"], new_receipt)
+            # The reference is taken first, so the counter isn't held locked while the upload is queued
+            reference = get_unique_reference(Receipt, "R")
+            with transaction.atomic():
+                new_receipt = Receipt.create(claim, category, date_incurred, amount, vat, description,
+                                             reference=reference)
+                new_receipt.save()
+                enqueue_receipt_image(new_receipt, request.FILES["file"])
 
             return HttpResponseRedirect(reverse("expensesapp:claim_details", args=[claim.reference]))
     else:
-        receipt_new_form = ReceiptNewForm(claim_ref=claim_ref, categories=categories)
+        receipt_new_form = ReceiptNewForm(claim_ref=claim.reference)
     return render(request, "expensesapp/receipt_new.html", {"claim": claim, "receipt_new_form": receipt_new_form})
 
 
 @login_required
-def receipt_details_view(request, receipt_ref):
-
-    # Check that the receipt exists
-    try:
-        receipt = Receipt.objects.get(reference=receipt_ref)
-    except Receipt.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
+@claim_permission_required("edit")
+@limit_upload_concurrency
+@receipt_upload
+def receipt_batch_new_view(request, claim):
+    added_receipts = []
+    if request.method == "POST":
+        receipt_formset = ReceiptBatchFormSet(request.POST, request.FILES,
+                                              form_kwargs={"upload_errors": request.receipt_upload_errors})
+        # Problems with the batch as a whole (e.g. too many receipts) reject all of it, but otherwise every valid
+        # receipt is added and only the invalid ones are shown again
+        if not receipt_formset.non_form_errors():
+            lines = [form for form in receipt_formset if not form.is_blank()]
+            valid_forms = [form for form in lines if form.is_valid()]
+            failed_forms = [form for form in lines if not form.is_valid()]
+            if valid_forms:
+                references = get_unique_references(Receipt, "R", len(valid_forms))
+                for form, reference in zip(valid_forms, references):
+                    added_receipts.append(Receipt.create(claim, category_table.get(form.cleaned_data["category"]),
+                                                         form.cleaned_data["date_incurred"],
+                                                         form.cleaned_data["amount"], form.cleaned_data["vat"],
+                                                         form.cleaned_data["description"], reference=reference))
+                with transaction.atomic():
+                    claim.lock()
+                    Receipt.objects.bulk_create(added_receipts)
+                    claim.refresh_summary()
+                    enqueue_receipt_images([(receipt, form.cleaned_data["file"])
+                                            for receipt, form in zip(added_receipts, valid_forms)])
+            if not failed_forms:
+                return HttpResponseRedirect(reverse("expensesapp:claim_details", args=[claim.reference]))
+            receipt_formset = get_lines_formset(receipt_formset, failed_forms)
+    else:
+        receipt_formset = ReceiptBatchFormSet()
+    return render(request, "expensesapp/receipt_batch_new.html", {"claim": claim, "receipt_formset": receipt_formset,
+                                                                  "added_receipts": added_receipts})
+
+
+# Returns a formset of just some of the lines of a submitted batch, renumbered from 0, so that they can be shown again
+# along with their errors
+def get_lines_formset(formset, forms):
+    data = {formset.management_form.add_prefix("TOTAL_FORMS"): len(forms),
+            formset.management_form.add_prefix("INITIAL_FORMS"): 0}
+    files = {}
+    upload_errors = {}
+    for line_num, form in enumerate(forms):
+        for field_name in form.fields:
+            old_key = form.add_prefix(field_name)
+            new_key = "{0}-{1}-{2}".format(formset.prefix, line_num, field_name)
+            if old_key in formset.data:
+                data[new_key] = formset.data[old_key]
+            if old_key in formset.files:
+                files[new_key] = formset.files[old_key]
+            if old_key in form.upload_errors:
+                upload_errors[new_key] = form.upload_errors[old_key]
+    lines_formset = ReceiptBatchFormSet(data, files, form_kwargs={"upload_errors": upload_errors})
+    lines_formset.full_clean()
+    return lines_formset
 
-    # Check that user has permission to access this receipt
-    if not receipt.claim.user_can_view(request.user):
-        return render(request, "expensesapp/access_denied.html")
 
-    receipt_delete_form = ReceiptDeleteForm(receipt_ref=receipt_ref)
+@login_required
+@receipt_permission_required("view", queryset=receipts_with_details)
+def receipt_details_view(request, receipt):
+    receipt_delete_form = ReceiptDeleteForm(receipt_ref=receipt.reference)
     return render(request, "expensesapp/receipt_details.html", {"receipt": receipt,
                                                                 "receipt_delete_form": receipt_delete_form})
 
 
 @login_required
-def receipt_edit_view(request, receipt_ref):
+def upload_metrics_view(request):
 
-    # Check that the receipt exists
-    try:
-        receipt = Receipt.objects.get(reference=receipt_ref)
-    except Receipt.DoesNotExist:
+    # Only staff can see the metrics
+    if not request.user.is_staff:
         return render(request, "expensesapp/access_denied.html")
 
-    # Check that user has permission to edit this receipt (only the owner has this permission)
-    if not receipt.claim.owner == request.user:
-        return render(request, "expensesapp/access_denied.html")
+    # Storage timings only cover the process that handles this request
+    return JsonResponse(dict(get_admission_metrics(), storage=get_storage_timings()))
+
+
+def image_status_not_found(request):
+    return JsonResponse({"status": None}, status=404)
+
+
+@login_required
+@receipt_permission_required("view", denied=image_status_not_found)
+def receipt_image_status_view(request, receipt):
+    return JsonResponse({"status": receipt.get_image_status_display() if receipt.image_status else None})
 
-    # Check that claim status is editable
-    if not receipt.claim.is_editable():
-        return render(request, "expensesapp/access_denied.html")
 
-    categories = Category.objects.order_by("name")
+@login_required
+@receipt_permission_required("view", denied=not_found)
+def receipt_image_view(request, receipt, size):
+
+    # Check that the receipt has an image
+    if not receipt.file:
+        raise Http404
+
+    if size != "full" and size not in RECEIPT_IMAGE_SIZES:
+        raise Http404
+    file_name = get_or_create_derivative(receipt.file, size)
+    return HttpResponseRedirect(receipt.file.storage.url(file_name))
+
+
+# Serves a file from LocalReceiptStorage. The signed URL is the permission to see it, as with S3, so that image links
+# behave the same with either storage. The file is read through the storage's memory map, so the response is streamed
+# straight from the page cache.
+def media_view(request, file_name):
+    storage = Receipt._meta.get_field("file").storage
+    if not isinstance(storage, LocalReceiptStorage):
+        raise Http404
+    if not storage.is_valid_signature(file_name, request.GET.get("expires"), request.GET.get("signature")):
+        raise Http404
+    try:
+        response = FileResponse(storage.open(file_name))
+    except FileNotFoundError:
+        raise Http404
+    response["Cache-Control"] = "private, max-age={0}".format(storage.url_expire)
+    return response
+
+
+@login_required
+@receipt_permission_required("edit", queryset=receipts_with_details)
+def receipt_edit_view(request, receipt):
     if request.method == "POST":
-        receipt_edit_form = ReceiptEditForm(request.POST, categories=categories, date_incurred=receipt.date_incurred,
+        receipt_edit_form = ReceiptEditForm(request.POST, date_incurred=receipt.date_incurred,
                                             category=receipt.category, amount=receipt.amount, vat=receipt.vat,
                                             description=receipt.description)
         if receipt_edit_form.is_valid():
             new_date_incurred = receipt_edit_form.cleaned_data["date_incurred"]
             receipt.date_incurred = new_date_incurred
             new_category = receipt_edit_form.cleaned_data["category"]
-            receipt.category = Category.objects.get(name=new_category)
+            receipt.category = category_table.get(new_category)
             new_amount = receipt_edit_form.cleaned_data["amount"]
             receipt.amount = new_amount
             new_vat = receipt_edit_form.cleaned_data["vat"]
@@ -244,7 +316,7 @@ def receipt_edit_view(request, receipt_ref):
             receipt.save()
             return HttpResponseRedirect(reverse("expensesapp:receipt_details", args=[receipt.reference]))
     else:
-        receipt_edit_form = ReceiptEditForm(categories=categories, date_incurred=receipt.date_incurred,
+        receipt_edit_form = ReceiptEditForm(date_incurred=receipt.date_incurred,
                                             category=receipt.category, amount=receipt.amount, vat=receipt.vat,
                                             description=receipt.description)
     return render(request, "expensesapp/receipt_edit.html", {"receipt": receipt,
@@ -252,22 +324,8 @@ def receipt_edit_view(request, receipt_ref):
 
 
 @login_required
-def receipt_delete_view(request, receipt_ref):
-
-    # Check that the receipt exists
-    try:
-        receipt = Receipt.objects.get(reference=receipt_ref)
-    except Receipt.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that user has permission to delete this receipt (only the owner has this permission)
-    if not receipt.claim.owner == request.user:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that claim status is editable
-    if not receipt.claim.is_editable():
-        return render(request, "expensesapp/access_denied.html")
-
+@receipt_permission_required("edit")
+def receipt_delete_view(request, receipt):
     if request.method == "POST":
         receipt_delete_form = ReceiptDeleteForm(request.POST, receipt_ref=receipt.reference)
         if receipt_delete_form.is_valid():
@@ -278,26 +336,13 @@ def receipt_delete_view(request, receipt_ref):
 
 
 @login_required
-def claim_submit_view(request, claim_ref):
-
-    # Check that the claim exists
-    try:
-        claim = Claim.objects.get(reference=claim_ref)
-    except Claim.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that user has permission to submit this claim (only the owner has this permission)
-    if not claim.owner == request.user:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that claim status is editable
-    if not claim.is_editable():
-        return render(request, "expensesapp/access_denied.html")
-
+@claim_permission_required("edit")
+def claim_submit_view(request, claim):
     if request.method == "POST":
-        claim_submit_form = ClaimSubmitForm(request.POST, claim_ref=claim_ref)
+        claim_submit_form = ClaimSubmitForm(request.POST, claim_ref=claim.reference)
         if claim_submit_form.is_valid():
             claim.submit()
+            claim.possible_duplicates = bool(find_duplicate_receipts(claim.receipts.all()))
             claim.save()
             return HttpResponseRedirect(reverse("expensesapp:claim_details", args=[claim.reference]))
     return render(request, "expensesapp/access_denied.html")
@@ -307,88 +352,41 @@ def claim_submit_view(request, claim_ref):
 def your_expenses_view(request, category, page_num):
 
     # Filter the users claims by selected category
+    claim_counts = request.user.get_claim_counts()
     if category == "all":
-        selected_claims = request.user.claims.all()
+        selected_claims = request.user.claims.select_related("currency")
+        total_count = claim_counts["all"]
     else:
         status_number = None
         for status in Claim.STATUSES:
             if status[1].lower() == category:
                 status_number = status[0]
         if status_number:
-            selected_claims = request.user.claims.filter(status=status_number)
+            selected_claims = request.user.claims.filter(status=status_number).select_related("currency")
+            total_count = claim_counts[status_number]
         else:
             return render(request, "expensesapp/access_denied.html")
 
-    # Filter the queryset of claims to show items based on page number (10 per page)
-    items_shown_per_page = 15
-    range_min = (page_num * items_shown_per_page) - items_shown_per_page + 1
-    range_max = page_num * items_shown_per_page
-    total_count = len(selected_claims)
-    # There are no claims
-    if total_count == 0:
-        if page_num == 1:
-            claim_list = []
-        else:
-            return HttpResponseRedirect(reverse("expensesapp:your_expenses", args=[category, 1]))
-    # No claims are in range
-    elif total_count < range_min:
-        if total_count >= range_min - items_shown_per_page:
+    # Get the page of claims to show (15 per page), newest first
+    paginator = KeysetPaginator(selected_claims, ["-status_update_datetime", "-id"], 15, count=total_count)
+    if page_num > paginator.num_pages:
+        if page_num - 1 == paginator.num_pages and paginator.count:
             return HttpResponseRedirect(reverse("expensesapp:your_expenses", args=[category, page_num - 1]))
         else:
             return HttpResponseRedirect(reverse("expensesapp:your_expenses", args=[category, 1]))
-    # 10 claims are in range
-    elif total_count >= range_max:
-        status_update_datetime_min = selected_claims.order_by("-status_update_datetime")[
-            range_min - 1].status_update_datetime
-        status_update_datetime_max = selected_claims.order_by("-status_update_datetime")[
-            range_max - 1].status_update_datetime
-        claim_list = selected_claims.filter(status_update_datetime__gte=status_update_datetime_max).filter(
-            status_update_datetime__lte=status_update_datetime_min).order_by("-status_update_datetime")
-    # 1 to 9 claims are in range
-    else:
-        status_update_datetime_min = selected_claims.order_by("-status_update_datetime")[
-            range_min - 1].status_update_datetime
-        claim_list = selected_claims.filter(status_update_datetime__lte=status_update_datetime_min).order_by(
-            "-status_update_datetime")
-
-    # Get data for pagination
-    max_pages = math.ceil(total_count / items_shown_per_page)
-    clickable_pages = []
-    newest_page = False
-    oldest_page = False
-    previous_page = False
-    next_page = False
-    for page in range(1, max_pages + 1):
-        if (page_num - 2) <= page <= (page_num + 2):
-            clickable_pages.append(page)
-            if page == page_num - 1:
-                previous_page = page
-            elif page == page_num + 1:
-                next_page = page
-        else:
-            if page == 1:
-                newest_page = page
-            if page == max_pages:
-                oldest_page = page
-    if clickable_pages == [1]:
-        clickable_pages = None
-
-    # Get URL info for back_view
-    request.user.back_url = ",".join(["expensesapp:your_expenses", category, str(page_num)])
-    request.user.save()
-
-    claim_categories = [{"name": "All", "count": len(request.user.claims.all())}]
+    elif page_num < 1:
+        return HttpResponseRedirect(reverse("expensesapp:your_expenses", args=[category, 1]))
+    page = paginator.get_page(page_num, request.GET.get("cursor"))
+    Claim.prefetch_row_versions(page.object_list)
+
+    claim_categories = [{"name": "All", "count": claim_counts["all"]}]
     for status in Claim.STATUSES:
-        claim_categories.append({"name": status[1], "count": len(request.user.claims.filter(status=status[0]))})
-    return render(request, "expensesapp/your_expenses.html", {"claim_list": claim_list,
-                                                              "claim_categories": claim_categories,
-                                                              "category": category,
-                                                              "current_page": page_num,
-                                                              "clickable_pages": clickable_pages,
-                                                              "newest_page": newest_page,
-                                                              "oldest_page": oldest_page,
-                                                              "previous_page": previous_page,
-                                                              "next_page": next_page})
+        claim_categories.append({"name": status[1], "count": claim_counts[status[0]]})
+    response = render(request, "expensesapp/your_expenses.html", {"claim_list": page.object_list,
+                                                                  "claim_categories": claim_categories,
+                                                                  "category": category,
+                                                                  **page.get_navigation()})
+    return set_back_url(request, response)
 
 
 @login_required
@@ -400,115 +398,50 @@ def manager_view(request, group_url, page_num):
 
     # Get claims in the users team
     your_teams_claims = request.user.get_your_teams_pending_claims()
-    if your_teams_claims:
-        your_teams_claims_len = len(your_teams_claims)
-    else:
-        your_teams_claims_len = 0
+    your_teams_claims_len = your_teams_claims.count()
 
     # Get claims in other teams
     other_teams_claims = request.user.get_other_teams_pending_claims()
-    if other_teams_claims:
-        other_teams_claims_len = len(other_teams_claims)
-    else:
-        other_teams_claims_len = 0
+    other_teams_claims_len = other_teams_claims.count()
 
     # Filter the team members' claims by selected category
     if group_url == "your-team":
         selected_claims = your_teams_claims
+        total_count = your_teams_claims_len
         group_name = "your team"
     elif group_url == "other-teams":
         selected_claims = other_teams_claims
+        total_count = other_teams_claims_len
         group_name = "other teams"
     else:
         return render(request, "expensesapp/access_denied.html")
-    if selected_claims:
-        selected_claims = selected_claims.order_by("submission_datetime")
-
-    # Filter the queryset of claims to show items based on page number (10 per page)
-    items_shown_per_page = 15
-    range_min = (page_num * items_shown_per_page) - items_shown_per_page + 1
-    range_max = page_num * items_shown_per_page
-    if selected_claims:
-        total_count = len(selected_claims)
-    else:
-        total_count = 0
-    if total_count == 0:  # No claims at all
-        if page_num == 1:
-            claim_list = []
-        else:
-            return HttpResponseRedirect(reverse("expensesapp:manager", args=[group_url, 1]))
-    elif total_count < range_min:  # No claims are in range
-        if total_count >= range_min - items_shown_per_page:
+    selected_claims = selected_claims.select_related("owner", "currency")
+
+    # Get the page of claims to show (15 per page), most recently submitted first
+    paginator = KeysetPaginator(selected_claims, ["-submission_datetime", "-id"], 15, count=total_count)
+    if page_num > paginator.num_pages:
+        if page_num - 1 == paginator.num_pages and paginator.count:
             return HttpResponseRedirect(reverse("expensesapp:manager", args=[group_url, page_num - 1]))
         else:
             return HttpResponseRedirect(reverse("expensesapp:manager", args=[group_url, 1]))
-    elif total_count >= range_max:  # 10 claims are in range
-        submission_datetime_min = selected_claims.order_by("-submission_datetime")[range_min - 1].submission_datetime
-        submission_datetime_max = selected_claims.order_by("-submission_datetime")[range_max - 1].submission_datetime
-        claim_list = selected_claims.filter(submission_datetime__gte=submission_datetime_max).filter(
-            submission_datetime__lte=submission_datetime_min).order_by("-submission_datetime")
-    else:  # 1 to 9 claims are in range
-        submission_datetime_min = selected_claims.order_by("-submission_datetime")[range_min - 1].submission_datetime
-        claim_list = selected_claims.filter(submission_datetime__lte=submission_datetime_min).order_by(
-            "-submission_datetime")
-
-    # Get data for pagination
-    max_pages = math.ceil(total_count / items_shown_per_page)
-    clickable_pages = []
-    newest_page = False
-    oldest_page = False
-    previous_page = False
-    next_page = False
-    for page in range(1, max_pages + 1):
-        if (page_num - 2) <= page <= (page_num + 2):
-            clickable_pages.append(page)
-            if page == page_num - 1:
-                previous_page = page
-            elif page == page_num + 1:
-                next_page = page
-        else:
-            if page == 1:
-                newest_page = page
-            if page == max_pages:
-                oldest_page = page
-    if clickable_pages == [1]:
-        clickable_pages = None
-
-    # Get URL info for back_view
-    request.user.back_url = ",".join(["expensesapp:manager", group_url, str(page_num)])
-    request.user.save()
+    elif page_num < 1:
+        return HttpResponseRedirect(reverse("expensesapp:manager", args=[group_url, 1]))
+    page = paginator.get_page(page_num, request.GET.get("cursor"))
+    Claim.prefetch_row_versions(page.object_list)
 
     claim_groups = [{"name": "Your Team", "url_name": "your-team", "count": your_teams_claims_len},
                     {"name": "Other Teams", "url_name": "other-teams", "count": other_teams_claims_len}]
-    return render(request, "expensesapp/manager.html", {"claim_list": claim_list,
-                                                        "claim_groups": claim_groups,
-                                                        "group_url": group_url,
-                                                        "group_name": group_name,
-                                                        "current_page": page_num,
-                                                        "clickable_pages": clickable_pages,
-                                                        "newest_page": newest_page,
-                                                        "oldest_page": oldest_page,
-                                                        "previous_page": previous_page,
-                                                        "next_page": next_page})
+    response = render(request, "expensesapp/manager.html", {"claim_list": page.object_list,
+                                                            "claim_groups": claim_groups,
+                                                            "group_url": group_url,
+                                                            "group_name": group_name,
+                                                            **page.get_navigation()})
+    return set_back_url(request, response)
 
 
 @login_required
-def claim_return_view(request, claim_ref):
-
-    # Check that the claim exists
-    try:
-        claim = Claim.objects.get(reference=claim_ref)
-    except Claim.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that the claim is one of the manager-user's pending claims (from their team or another team)
-    if claim not in request.user.get_all_teams_pending_claims():
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that claim status is "Pending"
-    if not claim.status == "2":
-        return render(request, "expensesapp/access_denied.html")
-
+@claim_permission_required("review")
+def claim_return_view(request, claim):
     if request.method == "POST":
         claim_return_form = ClaimReturnForm(request.POST)
         if claim_return_form.is_valid():
@@ -520,24 +453,10 @@ def claim_return_view(request, claim_ref):
 
 
 @login_required
-def claim_approve_view(request, claim_ref):
-
-    # Check that the claim exists
-    try:
-        claim = Claim.objects.get(reference=claim_ref)
-    except Claim.DoesNotExist:
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that the claim is one of the manager-user's pending claims
-    if claim not in request.user.get_all_teams_pending_claims():
-        return render(request, "expensesapp/access_denied.html")
-
-    # Check that claim status is "Pending"
-    if not claim.status == "2":
-        return render(request, "expensesapp/access_denied.html")
-
+@claim_permission_required("review")
+def claim_approve_view(request, claim):
     if request.method == "POST":
-        claim_approve_form = ClaimApproveForm(request.POST, claim_ref=claim_ref)
+        claim_approve_form = ClaimApproveForm(request.POST, claim_ref=claim.reference)
         if claim_approve_form.is_valid():
             claim.approve(request.user)
             claim.save()
@@ -547,5 +466,15 @@ def claim_approve_view(request, claim_ref):
 
 @login_required
 def back_view(request):
-    url_components = request.user.back_url.split(",")
-    return HttpResponseRedirect(reverse(url_components[0], args=[url_components[1], url_components[2]]))
+    back_url = request.get_signed_cookie("back_url", default=None, salt="expensesapp.back_url")
+    if not back_url or not url_has_allowed_host_and_scheme(back_url, allowed_hosts={request.get_host()}):
+        return HttpResponseRedirect(reverse("expensesapp:home"))
+    return HttpResponseRedirect(back_url)
+
+
+# Remembers the list page that the user is viewing, for back_view. This is kept in a signed cookie rather than on
+# the user, so that viewing a list page doesn't write to the database.
+def set_back_url(request, response):
+    response.set_signed_cookie("back_url", request.get_full_path(), salt="expensesapp.back_url", httponly=True,
+                               samesite="Lax")
+    return response
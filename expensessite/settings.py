@@ -1,8 +1,10 @@
 # Django settings for expensessite project.
 
 import os
+import tempfile
 import django_heroku
 import environ
+from django.core.exceptions import ImproperlyConfigured
 
 # Initialise environment variables
 env = environ.Env()
@@ -61,6 +63,7 @@ TEMPLATES = [
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
                 "django.template.context_processors.request",
+                "expensesapp.context_processors.user_role",
             ]
         },
     }
@@ -86,6 +89,27 @@ DATABASES = {
     }
 }
 
+# Cache
+# Cache versions (see caching.py) are only seen by the processes that share the cache they're bumped in, so on Heroku
+# CACHE_URL must point at a Redis or Memcached server shared by every dyno (e.g. redis://...), whose increments are
+# atomic. Without one (e.g. in development) each process keeps its own cache in memory, and its versions expire after
+# CACHE_VERSION_TIMEOUT seconds, so that changes made by other processes show up within that time.
+if env("CACHE_URL", default=None):
+    DEFAULT_CACHE = env.cache("CACHE_URL")
+    CACHE_VERSION_TIMEOUT = None
+elif "DYNO" in os.environ and not env.bool("CI", default=False):
+    raise ImproperlyConfigured("Set CACHE_URL to a Redis or Memcached server shared by every dyno.")
+else:
+    DEFAULT_CACHE = env.cache_url_config("locmemcache://expensesapp_cache?MAX_ENTRIES=100000")
+    CACHE_VERSION_TIMEOUT = 5
+
+CACHES = {
+    "default": DEFAULT_CACHE,
+    # Rendered claim table rows, which are stored under their claim's version, so each process can keep its own. The
+    # local memory cache evicts the least recently used rows once it's full.
+    "fragments": env.cache("FRAGMENT_CACHE_URL", default="locmemcache://expensesapp_fragments?MAX_ENTRIES=10000"),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -151,7 +175,49 @@ else:  # Pretending to send emails in development
     EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 
 # Media storage settings
-DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
-AWS_S3_ACCESS_KEY_ID = env("AWS_S3_ACCESS_KEY_ID")
-AWS_S3_SECRET_ACCESS_KEY = env("AWS_S3_SECRET_ACCESS_KEY")
-AWS_STORAGE_BUCKET_NAME = env("AWS_STORAGE_BUCKET_NAME")
+# Receipt images are stored on S3 when a bucket is configured, or otherwise in MEDIA_ROOT on this server (for
+# development, or a deployment with a single server), where they're served by the app. Heroku dynos each have their
+# own short-lived disk, and the worker processes read uploads from the media storage, so S3 is required there.
+MEDIA_STORAGE = env("MEDIA_STORAGE", default="s3" if env("AWS_STORAGE_BUCKET_NAME", default=None) else "local")
+if MEDIA_STORAGE == "local" and "DYNO" in os.environ and not env.bool("CI", default=False):
+    raise ImproperlyConfigured("Set AWS_STORAGE_BUCKET_NAME and the AWS_S3_* keys to store receipt images on S3.")
+if MEDIA_STORAGE == "local":
+    DEFAULT_FILE_STORAGE = "expensesapp.storage.LocalReceiptStorage"
+    MEDIA_ROOT = env("MEDIA_ROOT", default=os.path.join(BASE_DIR, "media"))
+else:
+    DEFAULT_FILE_STORAGE = "expensesapp.storage.ReceiptStorage"
+    AWS_S3_ACCESS_KEY_ID = env("AWS_S3_ACCESS_KEY_ID")
+    AWS_S3_SECRET_ACCESS_KEY = env("AWS_S3_SECRET_ACCESS_KEY")
+    AWS_STORAGE_BUCKET_NAME = env("AWS_STORAGE_BUCKET_NAME")
+# Connections shared by the threads of each process, and the size (in bytes) above which objects are uploaded in parts,
+# several at once. Run 'manage.py benchmark_storage' to compare settings.
+AWS_S3_MAX_POOL_CONNECTIONS = env.int("AWS_S3_MAX_POOL_CONNECTIONS", default=20)
+AWS_S3_MULTIPART_THRESHOLD = env.int("AWS_S3_MULTIPART_THRESHOLD", default=8 * 2 ** 20)
+AWS_S3_MULTIPART_CHUNKSIZE = env.int("AWS_S3_MULTIPART_CHUNKSIZE", default=8 * 2 ** 20)
+AWS_S3_MULTIPART_CONCURRENCY = env.int("AWS_S3_MULTIPART_CONCURRENCY", default=4)
+
+# Receipt image processing
+# Uploads are received into a local spool directory, then saved to the media storage and processed by a pool of worker
+# threads in each web process (or straight away if the number of workers is 0). The worker process in the Procfile
+# ('manage.py process_image_jobs --loop') picks up jobs that are retried, or were left behind by a restart.
+RECEIPT_IMAGE_SPOOL_DIR = env("RECEIPT_IMAGE_SPOOL_DIR",
+                              default=os.path.join(tempfile.gettempdir(), "expensesapp_uploads"))
+RECEIPT_IMAGE_WORKERS = env.int("RECEIPT_IMAGE_WORKERS", default=2)
+# How stored images are encoded: "jpeg", "webp" or "avif" (JPEG is used if Pillow can't write the chosen format), and
+# "colour", "greyscale" or "bilevel". Run 'manage.py benchmark_receipt_encoding' to compare settings.
+RECEIPT_IMAGE_FORMAT = env("RECEIPT_IMAGE_FORMAT", default="jpeg")
+RECEIPT_IMAGE_QUALITY = env.int("RECEIPT_IMAGE_QUALITY", default=95)
+# The quality of the smaller copies shown on pages, which is less noticeable at their size
+RECEIPT_IMAGE_DERIVATIVE_QUALITY = env.int("RECEIPT_IMAGE_DERIVATIVE_QUALITY", default=85)
+RECEIPT_IMAGE_COLOUR_MODE = env("RECEIPT_IMAGE_COLOUR_MODE", default="colour")
+RECEIPT_IMAGE_PROGRESSIVE = env.bool("RECEIPT_IMAGE_PROGRESSIVE", default=True)
+# Limits on receipt uploads, in bytes: each image, and the whole request (which can hold several images)
+RECEIPT_UPLOAD_MAX_FILE_SIZE = env.int("RECEIPT_UPLOAD_MAX_FILE_SIZE", default=20 * 1024 * 1024)
+RECEIPT_UPLOAD_MAX_REQUEST_SIZE = env.int("RECEIPT_UPLOAD_MAX_REQUEST_SIZE", default=100 * 1024 * 1024)
+# How many receipt uploads (and image processing jobs) can be handled at once by each process, and by all the
+# processes on this machine, and how many seconds an upload can wait for its turn before being turned away with a 503
+RECEIPT_UPLOAD_CONCURRENCY = env.int("RECEIPT_UPLOAD_CONCURRENCY", default=2)
+RECEIPT_UPLOAD_SITE_CONCURRENCY = env.int("RECEIPT_UPLOAD_SITE_CONCURRENCY", default=4)
+RECEIPT_UPLOAD_QUEUE_TIMEOUT = env.float("RECEIPT_UPLOAD_QUEUE_TIMEOUT", default=10)
+RECEIPT_UPLOAD_LOCK_DIR = env("RECEIPT_UPLOAD_LOCK_DIR",
+                              default=os.path.join(tempfile.gettempdir(), "expensesapp_upload_slots"))